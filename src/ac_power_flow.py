@@ -0,0 +1,367 @@
+#! /usr/local/bin/python
+# ac_power_flow.py - ACNetwork - ac_power_flow
+
+#==============================================================================
+# Copyright (C) 2010 James Brooks (kerspoon)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANDABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#==============================================================================
+
+"""
+by James Brooks 2010
+ac_power_flow.py - ACNetwork - ac_power_flow
+
+A Newton-Raphson power flow of a PsatData, giving a PsatReport like the
+one PSAT writes, so scenarios can be simulated without Matlab.
+"""
+
+#==============================================================================
+#  Imports:
+#==============================================================================
+
+from psat_data import PsatData, Islanded
+from psat_report import PsatReport
+from dc_power_flow import line_limit
+from modifiedtestcase import ModifiedTestCase
+from StringIO import StringIO
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+import unittest
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class ACNetwork(object):
+    """
+    The sparse admittance matrix (Y-bus) of a PsatData and its bus
+    types: the slack, PV busses (with a PV.con generator) and PQ busses
+    (the rest).
+
+    Lines are pi models with the tap ratio & phase shift of an ideal
+    transformer at the `fbus` end (as PSAT). Shunts add g + jb to their
+    bus. Loads are constant power.
+    """
+
+    def __init__(self, psat):
+
+        islands = psat.islanding()
+        if islands:
+            raise Islanded(islands)
+
+        self.bus_nos = sorted(psat.busses)
+        self.bus_index = dict((bus_no, n) for n, bus_no in enumerate(self.bus_nos))
+        index = self.bus_index
+        nbus = len(self.bus_nos)
+
+        lines = [line for _, line in sorted(psat.lines.items()) if line.status]
+        self.line_ids = [line.cid for line in lines]
+        self.fbus = numpy.array([index[x.fbus] for x in lines], int)
+        self.tbus = numpy.array([index[x.tbus] for x in lines], int)
+        self.limit = numpy.array([line_limit(x) for x in lines], float)
+
+        series = 1.0 / numpy.array([complex(x.r, x.x) for x in lines])
+        charging = 1j * numpy.array([x.b for x in lines]) / 2
+        tap = (numpy.array([x.tap or 1.0 for x in lines]) *
+               numpy.exp(1j * numpy.radians([x.shift for x in lines])))
+        self.y_ff = (series + charging) / (tap * tap.conj())
+        self.y_ft = -series / tap.conj()
+        self.y_tf = -series / tap
+        self.y_tt = series + charging
+
+        shunt = numpy.zeros(nbus, complex)
+        for item in psat.shunts.values():
+            shunt[index[item.bus_no]] += complex(item.g, item.b)
+
+        rows = numpy.concatenate((self.fbus, self.fbus, self.tbus, self.tbus,
+                                  numpy.arange(nbus)))
+        cols = numpy.concatenate((self.fbus, self.tbus, self.fbus, self.tbus,
+                                  numpy.arange(nbus)))
+        vals = numpy.concatenate((self.y_ff, self.y_ft, self.y_tf, self.y_tt, shunt))
+        self.ybus = scipy.sparse.csr_matrix((vals, (rows, cols)), (nbus, nbus))
+
+        # bus types
+        slack_busses = [index[x.bus_no] for x in psat.slack.values()]
+        if not slack_busses:
+            slack_busses = [0]
+        self.slack = slack_busses[0]
+        pv = set(index[x.bus_no] for x in psat.generators.values()) - set(slack_busses)
+        self.pv = numpy.array(sorted(pv), int)
+        self.pq = numpy.array(sorted(set(range(nbus)) - pv - set(slack_busses)), int)
+
+    def start(self, psat):
+        """the voltage magnitudes and angles to start from: the guesses
+           in Bus.con with the set voltages of the generators and slack"""
+        index = self.bus_index
+        mag = numpy.ones(len(self.bus_nos))
+        ang = numpy.zeros(len(self.bus_nos))
+        for bus in psat.busses.values():
+            mag[index[bus.bus_no]] = bus.v_magnitude_guess or 1.0
+            ang[index[bus.bus_no]] = bus.v_angle_guess
+        for gen in psat.generators.values():
+            mag[index[gen.bus_no]] = gen.v
+        for slack in psat.slack.values():
+            mag[index[slack.bus_no]] = slack.v_magnitude
+            ang[index[slack.bus_no]] = slack.ref_angle
+        return mag, ang
+
+    def loads(self, psat):
+        """the complex power drawn by the loads at each bus"""
+        load = numpy.zeros(len(self.bus_nos), complex)
+        for item in psat.loads.values():
+            load[self.bus_index[item.bus_no]] += complex(item.p, item.q)
+        return load
+
+    def injection(self, psat):
+        """the scheduled complex power into each bus (the slack's and
+           the reactive power of generators are found by the solve)"""
+        power = -self.loads(psat)
+        for gen in psat.generators.values():
+            power[self.bus_index[gen.bus_no]] += gen.p
+        return power
+
+    def solve(self, mag, angle, power, tolerance=1e-5, max_iterations=50):
+        """Newton-Raphson from `mag` & `angle` to meet `power` at the PV 
+           & PQ busses (P) and the PQ busses (Q). Returns the voltage 
+           magnitudes and angles, if it converged and the iterations."""
+
+        ybus = self.ybus
+        pvpq = numpy.concatenate((self.pv, self.pq))
+        npvpq, npq = len(pvpq), len(self.pq)
+        mag, angle = mag.copy(), angle.copy()
+        volts = mag * numpy.exp(1j * angle)
+
+        def mismatch(volts):
+            calc = volts * (ybus * volts).conj()
+            diff = calc - power
+            return numpy.concatenate((diff[pvpq].real, diff[self.pq].imag))
+
+        for iteration in range(max_iterations + 1):
+            error = mismatch(volts)
+            if not len(error) or numpy.abs(error).max() < tolerance:
+                return mag, angle, True, iteration
+            if iteration == max_iterations:
+                break
+
+            # dS/dVa & dS/dVm (as MATPOWER's dSbus_dV)
+            current = ybus * volts
+            diag_v = scipy.sparse.diags(volts)
+            diag_i = scipy.sparse.diags(current)
+            diag_norm = scipy.sparse.diags(volts / numpy.abs(volts))
+            ds_dvm = diag_v * (ybus * diag_norm).conj() + diag_i.conj() * diag_norm
+            ds_dva = 1j * diag_v * (diag_i - ybus * diag_v).conj()
+
+            ds_dva = ds_dva.tocsc()
+            ds_dvm = ds_dvm.tocsc()
+            jacobian = scipy.sparse.bmat([
+                [ds_dva[pvpq][:, pvpq].real, ds_dvm[pvpq][:, self.pq].real],
+                [ds_dva[self.pq][:, pvpq].imag, ds_dvm[self.pq][:, self.pq].imag]],
+                format="csc")
+            step = scipy.sparse.linalg.spsolve(jacobian, -error)
+
+            angle[pvpq] += step[:npvpq]
+            mag[self.pq] += step[npvpq:npvpq + npq]
+            volts = mag * numpy.exp(1j * angle)
+
+        return mag, angle, False, max_iterations
+
+    def line_flows(self, volts):
+        """the complex power into each line at its `fbus` & `tbus` end"""
+        v_f, v_t = volts[self.fbus], volts[self.tbus]
+        s_from = v_f * (self.y_ff * v_f + self.y_ft * v_t).conj()
+        s_to = v_t * (self.y_tf * v_f + self.y_tt * v_t).conj()
+        return s_from, s_to
+
+    def report(self, psat, mag, angle, converged):
+        """a PsatReport of the solution that fails where PSAT's would,
+           with the reasons in `violations` and the `line_flow` (complex
+           power at the fbus end) of each line"""
+
+        report = PsatReport()
+        index = self.bus_index
+        load = self.loads(psat)
+        volts = mag * numpy.exp(1j * angle)
+        gen = volts * (self.ybus * volts).conj() + load
+        if converged:
+            # what was asked for, rather than it to within the tolerance
+            scheduled = self.injection(psat) + load
+            gen[self.pv] = scheduled[self.pv].real + 1j * gen[self.pv].imag
+            gen[self.pq] = scheduled[self.pq]
+
+        for n, bus_no in enumerate(self.bus_nos):
+            report.power_flow[bus_no] = PsatReport.PowerFlow(
+                bus_no, mag[n], angle[n], gen[n].real, gen[n].imag,
+                load[n].real, load[n].imag)
+
+        s_from, s_to = self.line_flows(volts)
+        report.line_flow = dict(zip(self.line_ids, s_from))
+
+        violations = []
+        if not converged:
+            violations.append("did not converge")
+
+        # the sanity checks PsatReport.read makes of each bus
+        for n, bus_no in enumerate(self.bus_nos):
+            values = [mag[n], gen[n].real, gen[n].imag, load[n].real, load[n].imag]
+            if max(abs(x) for x in values) > 10 or abs(angle[n]) > 1:
+                violations.append("bus %d out of range" % bus_no)
+
+        for item in psat.loads.values():
+            v = mag[index[item.bus_no]]
+            if not item.v_min <= v <= item.v_max:
+                violations.append("bus %d voltage %f" % (item.bus_no, v))
+
+        units = psat.generators.values() + psat.slack.values()
+        for unit in units:
+            q = gen[index[unit.bus_no]].imag
+            if not unit.q_min <= q <= unit.q_max:
+                violations.append("bus %d reactive power %f" % (unit.bus_no, q))
+
+        flow = numpy.maximum(numpy.abs(s_from), numpy.abs(s_to))
+        for n in (flow > self.limit).nonzero()[0]:
+            violations.append("line %s flow %f" % (self.line_ids[n], flow[n]))
+
+        report.num_bus = len(self.bus_nos)
+        report.num_line = len(self.line_ids)
+        report.num_generator = len(psat.generators)
+        report.num_load = len(psat.loads)
+        report.power_rate = 100
+        report.converged = converged
+        report.violations = violations
+        report.acceptable = not violations
+        return report
+
+
+def ac_power_flow(psat, tolerance=1e-5, max_iterations=50):
+    """func ac_power_flow :: PsatData -> PsatReport
+       ----
+       the AC power flow of `psat` (see ACNetwork.report). Raises
+       Islanded if the network isn't whole.
+    """
+    network = ACNetwork(psat)
+    mag, angle = network.start(psat)
+    mag, angle, converged, iterations = network.solve(
+        mag, angle, network.injection(psat), tolerance, max_iterations)
+    report = network.report(psat, mag, angle, converged)
+    report.iterations = iterations
+    return report
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_ac_power_flow(ModifiedTestCase):
+
+    text = """Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+3 138 1 0 2 1;
+];
+
+Line.con = [ ...
+1 2 100 138 60 0.0 0.0 0.01 0.1 0.02 0.0 0.0 0.0 0.0 2.0 1; %a1
+2 3 100 138 60 0.0 0.0 0.01 0.1 0.02 0.0 0.0 0.0 0.0 2.0 1; %a2
+1 3 100 138 60 0.0 0.0 0.02 0.2 0.02 1.05 3.0 0.0 0.0 2.0 1; %a3
+];
+
+SW.con = [ ...
+1 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+PV.con = [ ...
+2 100 138 0.5 1.02 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+PQ.con = [ ...
+3 100 138 1.2 0.3 1.1 0.9 1 1;
+];
+
+Shunt.con = [ ...
+3 100 138 60 0.01 0.1 1;
+];
+
+Supply.con = [ ...
+1 100 0.1 2.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+2 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""
+
+    def setUp(self):
+        self.psat = PsatData()
+        self.psat.read(StringIO(self.text))
+
+    def volts(self, report):
+        return numpy.array([report.power_flow[n].v *
+                            numpy.exp(1j * report.power_flow[n].phase)
+                            for n in [1, 2, 3]])
+
+    def test_solution(self):
+        report = ac_power_flow(self.psat)
+        self.assertTrue(report.converged)
+        self.assertTrue(report.in_limit(), report.violations)
+        pf = report.power_flow
+        self.assertAlmostEqual(pf[1].v, 1.04)
+        self.assertAlmostEqual(pf[2].v, 1.02)
+        self.assertAlmostEqual(pf[1].phase, 0.0)
+        self.assertAlmostEqual(pf[2].pg, 0.5, 4)
+        self.assertAlmostEqual(pf[3].pl, 1.2)
+
+        # an independent check of the power at each bus
+        volts = self.volts(report)
+        y = 1 / complex(0.01, 0.1)
+        y3 = 1 / complex(0.02, 0.2)
+        m = 1.05 * numpy.exp(1j * numpy.radians(3.0))
+        ybus = numpy.array([
+            [y + 0.01j + (y3 + 0.01j) / 1.05 ** 2, -y, -y3 / m.conjugate()],
+            [-y, 2 * y + 0.02j, -y],
+            [-y3 / m, -y, y + y3 + 0.02j + complex(0.01, 0.1)]])
+        power = volts * ybus.dot(volts).conj()
+        self.assertAlmostEqual(power[1].real, 0.5, 4)
+        self.assertAlmostEqual(power[2].real, -1.2, 4)
+        self.assertAlmostEqual(power[2].imag, -0.3, 4)
+        self.assertAlmostEqual(power[0].real, pf[1].pg, 4)
+
+        # there are losses
+        self.assertTrue(pf[1].pg + pf[2].pg > pf[3].pl)
+
+    def test_violations(self):
+        self.psat.generators[2].q_max = 0.01
+        self.psat.lines["a1"].s_limit = 0.1
+        report = ac_power_flow(self.psat)
+        self.assertFalse(report.in_limit())
+        self.assertEqual(len(report.violations), 2)
+
+    def test_diverge(self):
+        self.psat.loads[3].p = 50.0
+        report = ac_power_flow(self.psat, max_iterations=10)
+        self.assertFalse(report.converged)
+        self.assertFalse(report.in_limit())
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+#==============================================================================
+#
+#==============================================================================
@@ -2,8 +2,10 @@
 
 
 import random
+import math
 from modifiedtestcase import ModifiedTestCase
 import unittest
+import numpy
 from misc import Error
 
 
@@ -20,6 +22,8 @@ daily = dict(
     Saturday=77,
     Sunday=75)
 
+days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
 def weekend(day):
     return day == "Saturday" or day == "Sunday"
 
@@ -84,6 +88,18 @@ def forecast_load(week, day, hour):
     # print m1, m2, m3, m 
     return m
 
+def make_forecast_table():
+    """forecast_load for every week, day (in order of `days`) and hour"""
+    table = numpy.zeros((52, 7, 24))
+    for week in range(52):
+        for n, day in enumerate(days):
+            for hour in range(24):
+                table[week, n, hour] = forecast_load(week, day, hour)
+    return table
+
+# forecast_table[week][day][hour] where day 0 is Monday
+forecast_table = make_forecast_table()
+
 def actual_load(week, day, hour):
     mu = forecast_load(week, day, hour)
     sigma = mu * 0.05
@@ -99,7 +115,7 @@ def actual_load2(forecast):
 # randint(self, a, b)  Return random integer in range [a, b], including both end points.
 
 def random_day():
-    return random.choice(["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"])
+    return random.choice(days)
 
 def random_week():
     return random.randint(0, 51)
@@ -108,7 +124,19 @@ def random_hour():
     return random.randint(0, 23)
 
 def random_bus_forecast():
-    return forecast_load(random_week(), random_day(), random_hour())
+    return float(forecast_table[random_week(), random.randint(0, 6), random_hour()])
+
+def random_bus_forecasts(count):
+    """`count` samples of random_bus_forecast as an array. Every hour of
+       the year is equally likely so just pick from the flattened table."""
+    hours = numpy.random.randint(0, forecast_table.size, count)
+    return forecast_table.reshape(-1)[hours]
+
+def actual_loads(forecast, count):
+    """`count` samples of actual_load2(forecast) as an array. `forecast`
+       can be a number or an array of `count` forecasts."""
+    forecast = numpy.asarray(forecast, float)
+    return numpy.random.normal(forecast, forecast * 0.05, count)
 
 def quantised_01(val):
     return round(val, 2)
@@ -117,6 +145,92 @@ def quantised_05(x):
     val = 0.05
     return round(x / val) * val
 
+def quantised_05_array(x):
+    """quantised_05 for each element of `x`, rounding halves away from 
+       zero as `round` does (numpy.round would round them to even)."""
+    val = 0.05
+    x = numpy.asarray(x, float)
+    return numpy.sign(x) * numpy.floor(numpy.abs(x) / val + 0.5) * val
+
+
+def forecast_distribution():
+    """the exact distribution of quantised_05(random_bus_forecast()) as
+       the list of levels and the probability of each"""
+    steps = numpy.floor(forecast_table.reshape(-1) / 0.05 + 0.5)
+    steps, counts = numpy.unique(steps, return_counts=True)
+    return steps * 0.05, counts / float(forecast_table.size)
+
+def actual_distribution(forecast=1.0, width=8):
+    """the distribution of quantised_05(actual_load2(forecast)) as the 
+       list of levels and the probability of each. Levels more than 
+       `width` standard deviations from the forecast are left out."""
+    sigma = forecast * 0.05
+
+    def normal_cdf(x):
+        return 0.5 * (1 + math.erf((x - forecast) / (sigma * math.sqrt(2))))
+
+    low = numpy.floor((forecast - width * sigma) / 0.05 + 0.5)
+    high = numpy.floor((forecast + width * sigma) / 0.05 + 0.5)
+    steps = numpy.arange(low, high + 1)
+    probabilities = numpy.array([normal_cdf((step + 0.5) * 0.05) - 
+                                 normal_cdf((step - 0.5) * 0.05) 
+                                 for step in steps])
+    return steps * 0.05, probabilities / probabilities.sum()
+
+
+class AliasTable(object):
+    """
+    Sample from a discrete distribution in O(1) per sample using Vose's 
+    alias method. Each column `n` is chosen with equal probability, then
+    keeps its own value with probability `accept[n]` or otherwise takes 
+    the value of `alias[n]`.
+
+        table = AliasTable([0.9, 0.95, 1.0], [0.25, 0.5, 0.25])
+        table.sample(1000000)
+    """
+
+    def __init__(self, values, probabilities):
+        probabilities = numpy.asarray(probabilities, float)
+        if len(probabilities) == 0 or probabilities.sum() <= 0: 
+            raise Error("need at least one value with a probability")
+        if len(values) != len(probabilities):
+            raise Error("a probability for each value is needed")
+
+        count = len(probabilities)
+        self.values = numpy.asarray(values)
+        self.probabilities = probabilities / probabilities.sum()
+        self.accept = numpy.ones(count)
+        self.alias = numpy.arange(count)
+
+        scaled = self.probabilities * count
+        small = [n for n in range(count) if scaled[n] < 1.0]
+        large = [n for n in range(count) if scaled[n] >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.accept[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # anything left over is only there due to rounding errors
+
+    def probability(self, value):
+        """the probability of sampling `value`"""
+        return float(self.probabilities[self.values == value].sum())
+
+    def sample(self, count):
+        """an array of `count` random values"""
+        column = numpy.random.randint(0, len(self.values), count)
+        keep = numpy.random.random(count) < self.accept[column]
+        return self.values[numpy.where(keep, column, self.alias[column])]
+
+# the demand used by NetworkProbability outages and failures 
+forecast_demand = AliasTable(*forecast_distribution())
+actual_demand = AliasTable(*actual_distribution(1.0))
+
 
 class Tester_quantised(ModifiedTestCase):
     def test_01(self):
@@ -139,6 +253,13 @@ class Tester_quantised(ModifiedTestCase):
 
         self.assertEqual(quantised_05(0.9999), 1.00)
 
+    def test_05_array(self):
+        values = [0.0, 0.005, 0.0049, 0.0149, 0.0250, 0.0249, 0.0749, 
+                  0.0751, 0.9999, 1.3, -0.0251]
+        values += list(numpy.random.uniform(0, 2, 1000))
+        self.assertEqual(list(quantised_05_array(values)), 
+                         [quantised_05(x) for x in values])
+
 
 def examples():
     def inner(forecast):
@@ -177,6 +298,41 @@ def examples():
     print "-----"
 
 
+class Tester_distribution(ModifiedTestCase):
+    def test_forecast(self):
+        levels, probabilities = forecast_distribution()
+        self.assertAlmostEqual(probabilities.sum(), 1.0)
+        quantised = quantised_05_array(forecast_table.reshape(-1))
+        for level, probability in zip(levels, probabilities):
+            self.assertEqual(level, quantised_05(level))
+            self.assertAlmostEqual(probability, (quantised == level).mean())
+
+    def test_actual(self):
+        levels, probabilities = actual_distribution(1.0)
+        self.assertAlmostEqual(probabilities.sum(), 1.0)
+        self.assertEqual(levels[probabilities.argmax()], 1.0)
+        # P(0.975 <= x < 1.025) is P(-0.5 <= z < 0.5) 
+        self.assertAlmostEqual(probabilities.max(), 0.382925, 5)
+        self.assertAlmostEqual(actual_demand.probability(1.05), 0.241730, 5)
+
+    def test_alias(self):
+        table = AliasTable(["a", "b", "c", "d"], [0.1, 0.2, 0.3, 0.4])
+        sample = table.sample(100000)
+        for value, probability in zip("abcd", [0.1, 0.2, 0.3, 0.4]):
+            self.assertAlmostEqual((sample == value).mean(), probability, 2)
+            self.assertAlmostEqual(table.probability(value), probability)
+        self.assertEqual(table.probability("e"), 0.0)
+
+    def test_alias_one(self):
+        table = AliasTable([1.0], [3.0])
+        self.assertEqual(list(table.sample(3)), [1.0, 1.0, 1.0])
+
+    def test_demand(self):
+        sample = actual_demand.sample(100000)
+        self.assertEqual(set(quantised_05_array(sample)), set(sample))
+        self.assertAlmostEqual(sample.mean(), 1.0, 2)
+
+
 class Tester_Weekstuff(ModifiedTestCase):
     def test_weektype(self):
         for x in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]:
@@ -227,6 +383,25 @@ class Tester_Weekstuff(ModifiedTestCase):
         self.assertAlmostEqual(forecast_load(51, "Sunday", 23), 0.578, 3)
         self.assertAlmostEqual(forecast_load(37, "Tuesday", 12), 0.646, 3)
 
+    def test_forecast_table(self):
+        self.assertEqual(forecast_table.shape, (52, 7, 24))
+        self.assertEqual(forecast_table[37, 1, 12], forecast_load(37, "Tuesday", 12))
+        self.assertEqual(forecast_table[51, 6, 23], forecast_load(51, "Sunday", 23))
+
+    def test_random_forecasts(self):
+        forecasts = random_bus_forecasts(10000)
+        self.assertEqual(len(forecasts), 10000)
+        self.assertTrue(forecasts.min() >= forecast_table.min())
+        self.assertTrue(forecasts.max() <= forecast_table.max())
+        self.assertAlmostEqual(forecasts.mean(), forecast_table.mean(), 2)
+
+    def test_actual_loads(self):
+        loads = actual_loads(0.8, 10000)
+        self.assertAlmostEqual(loads.mean(), 0.8, 2)
+        self.assertAlmostEqual(loads.std(), 0.04, 2)
+        loads = actual_loads(numpy.array([0.5, 1.0]), 2)
+        self.assertEqual(len(loads), 2)
+
 def show_all():
     from misc import as_csv
     weeks = range(52)
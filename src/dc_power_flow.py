@@ -0,0 +1,537 @@
+#! /usr/local/bin/python
+# dc_power_flow.py - DCNetwork - dc_power_flow
+
+#==============================================================================
+# Copyright (C) 2010 James Brooks (kerspoon)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANDABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#==============================================================================
+
+"""
+by James Brooks 2010
+dc_power_flow.py - DCNetwork - dc_power_flow
+
+A linear (DC) power flow of a PsatData so scenarios can be screened
+without Matlab: B theta = P, with the flow on each line limited by
+the ratings in Line.con.
+"""
+
+#==============================================================================
+#  Imports:
+#==============================================================================
+
+from misc import writable
+from psat_data import PsatData, Islanded
+from psat_report import PsatReport
+from modifiedtestcase import ModifiedTestCase
+from StringIO import StringIO
+import math
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.optimize
+import unittest
+
+#==============================================================================
+#
+#==============================================================================
+
+
+def line_limit(line):
+    """the tightest of the p, s & i limits of `line` that is set (>0) as
+       a limit on real power (at 1 pu volts) or infinity if none are"""
+    limits = [x for x in (line.p_limit, line.s_limit, line.i_limit) if x > 0]
+    if limits:
+        return min(limits)
+    return numpy.inf
+
+
+class DCNetwork(object):
+    """
+    The DC model of the network of a PsatData: the lines in service as
+    a susceptance matrix over the busses, factorised once without the
+    slack so that any number of injections can be solved against it.
+
+    Each line has susceptance 1 / (x * tap) and a phase shift, r and b
+    are ignored as are voltages (all 1 pu) and reactive power.
+
+    Given the `base` DCNetwork of a PsatData that `psat` only removes
+    lines or busses from, its factorisation is reused with a low rank
+    update (see LowRankUpdate) rather than factorising again.
+    """
+
+    def __init__(self, psat, base=None):
+
+        islands = psat.islanding()
+        if islands:
+            raise Islanded(islands)
+
+        self.bus_nos = sorted(psat.busses)
+        self.bus_index = dict((bus_no, n) for n, bus_no in enumerate(self.bus_nos))
+
+        if psat.slack:
+            slack = psat.slack.values()[0]
+            self.slack_bus = slack.bus_no
+            self.ref_angle = slack.ref_angle
+        else:
+            self.slack_bus = self.bus_nos[0]
+            self.ref_angle = 0.0
+        self.slack = self.bus_index[self.slack_bus]
+
+        lines = [line for _, line in sorted(psat.lines.items()) if line.status]
+        self.line_ids = [line.cid for line in lines]
+        self.line_index = dict((cid, n) for n, cid in enumerate(self.line_ids))
+        self.fbus = numpy.array([self.bus_index[x.fbus] for x in lines], int)
+        self.tbus = numpy.array([self.bus_index[x.tbus] for x in lines], int)
+        taps = numpy.array([x.tap or 1.0 for x in lines], float)
+        self.susceptance = 1.0 / (numpy.array([x.x for x in lines], float) * taps)
+        self.shift = numpy.radians([x.shift for x in lines])
+        self.limit = numpy.array([line_limit(x) for x in lines], float)
+
+        # incidence (line x bus) and B = A' diag(b) A
+        nline, nbus = len(lines), len(self.bus_nos)
+        rows = numpy.concatenate((numpy.arange(nline), numpy.arange(nline)))
+        cols = numpy.concatenate((self.fbus, self.tbus))
+        vals = numpy.concatenate((numpy.ones(nline), -numpy.ones(nline)))
+        self.incidence = scipy.sparse.csc_matrix((vals, (rows, cols)), (nline, nbus))
+        self.bbus = (self.incidence.T *
+                     scipy.sparse.diags(self.susceptance) * self.incidence).tocsc()
+
+        self.keep = numpy.array([n for n in range(nbus) if n != self.slack], int)
+        self.lu = None
+        if base is not None:
+            self.lu = low_rank_update(base, self)
+        if self.lu is None:
+            self.lu = scipy.sparse.linalg.splu(self.bbus[self.keep][:, self.keep].tocsc())
+
+    def injection(self, psat):
+        """the net real power into each bus (generation less load) of
+           `psat`, which has the same network; the slack's is a guess"""
+        power = numpy.zeros(len(self.bus_nos))
+        index = self.bus_index
+        for gen in psat.generators.values():
+            power[index[gen.bus_no]] += gen.p
+        for slack in psat.slack.values():
+            power[index[slack.bus_no]] += slack.p_guess
+        for load in psat.loads.values():
+            power[index[load.bus_no]] -= load.p
+        for shunt in psat.shunts.values():
+            power[index[shunt.bus_no]] -= shunt.g
+        return power
+
+    def solve(self, power):
+        """the bus angles (in radians) and line flows for the net
+           injections `power`, the slack taking up any imbalance"""
+        # the phase shifters act as a pair of injections at their ends
+        shifted = self.susceptance * self.shift
+        power = (power + numpy.bincount(self.fbus, shifted, len(power)) -
+                 numpy.bincount(self.tbus, shifted, len(power)))
+        angles = numpy.empty(len(power))
+        angles[self.slack] = 0.0
+        angles[self.keep] = self.lu.solve(power[self.keep])
+        angles += self.ref_angle
+        flows = self.susceptance * (angles[self.fbus] - angles[self.tbus] - self.shift)
+        return angles, flows
+
+    def ptdf(self):
+        """the power transfer distribution factors (line x bus) as a
+           dense array: the change in the flow on each line for a unit
+           of power injected at each bus and taken out at the slack"""
+        weighted = scipy.sparse.diags(self.susceptance) * self.incidence
+        factors = numpy.zeros(weighted.shape)
+        factors[:, self.keep] = self.lu.solve(
+            weighted[:, self.keep].T.toarray()).T
+        return factors
+
+    def overloads(self, flows):
+        """the lines with flows over their limit as a list of
+           (cid, flow, limit), most overloaded first"""
+        over = (numpy.abs(flows) > self.limit).nonzero()[0]
+        ratio = numpy.abs(flows[over]) / self.limit[over]
+        return [(self.line_ids[n], flows[n], self.limit[n])
+                for n in over[numpy.argsort(-ratio, kind="mergesort")]]
+
+    def report(self, psat, angles, flows):
+        """a PsatReport of the solution, so report_in_limits and
+           report_to_psat can use it. It also has the `line_flow` of
+           each line and the `overloads` that make it fail."""
+        report = PsatReport()
+        nbus = len(self.bus_nos)
+        index = self.bus_index
+
+        net = (numpy.bincount(self.fbus, flows, nbus) -
+               numpy.bincount(self.tbus, flows, nbus))
+        load = numpy.zeros(nbus)
+        q_load = numpy.zeros(nbus)
+        for item in psat.loads.values():
+            load[index[item.bus_no]] += item.p
+            q_load[index[item.bus_no]] += item.q
+        # shunts are only in the injection, not the PQ load (pl)
+        shunt = numpy.zeros(nbus)
+        for item in psat.shunts.values():
+            shunt[index[item.bus_no]] += item.g
+        volts = numpy.ones(nbus)
+        for gen in psat.generators.values():
+            volts[index[gen.bus_no]] = gen.v
+        for slack in psat.slack.values():
+            volts[index[slack.bus_no]] = slack.v_magnitude
+
+        for n, bus_no in enumerate(self.bus_nos):
+            report.power_flow[bus_no] = PsatReport.PowerFlow(
+                bus_no, volts[n], angles[n], net[n] + load[n] + shunt[n], 0.0,
+                load[n], q_load[n])
+
+        report.num_bus = nbus
+        report.num_line = len(self.line_ids)
+        report.num_generator = len(psat.generators)
+        report.num_load = len(psat.loads)
+        report.power_rate = 100
+        report.line_flow = dict(zip(self.line_ids, flows))
+        report.overloads = self.overloads(flows)
+        report.acceptable = not report.overloads
+        return report
+
+
+class LowRankUpdate(object):
+    """
+    Solves the reduced B of a DCNetwork that is the `base` one less some
+    lines & busses using the base factorisation (Sherman-Morrison-
+    Woodbury). Losing k lines & busses is a rank k change U C U' of the
+    base B: each line takes off b a a' (a its +1/-1 incidence) and each
+    bus, with its lines gone, gets a 1 on the diagonal so its angle is 0.
+    Then
+
+        (B + U C U')^-1 r = y - Z (C^-1 + U' Z)^-1 U' y
+
+    with y = B^-1 r and Z = B^-1 U found once, so each solve is a base
+    solve plus O(n k).
+    """
+
+    def __init__(self, base, index, lines, busses):
+        count = len(base.keep)
+        reduced = -numpy.ones(len(base.bus_nos), int)
+        reduced[base.keep] = numpy.arange(count)
+
+        update = numpy.zeros((count, len(lines) + len(busses)))
+        for n, line in enumerate(lines):
+            for bus, sign in ((base.fbus[line], 1.0), (base.tbus[line], -1.0)):
+                if reduced[bus] >= 0:
+                    update[reduced[bus], n] = sign
+        for n, bus in enumerate(busses):
+            update[reduced[bus], len(lines) + n] = 1.0
+        weights = numpy.concatenate((-base.susceptance[lines], 
+                                     numpy.ones(len(busses))))
+
+        self.lu = base.lu
+        self.count = count
+        self.index = reduced[index]
+        self.update = update
+        self.solved = update
+        self.capacitance = numpy.zeros((0, 0))
+        if len(weights):
+            self.solved = base.lu.solve(update)
+            self.capacitance = numpy.linalg.inv(
+                numpy.diag(1.0 / weights) + numpy.dot(update.T, self.solved))
+
+    def solve(self, rhs):
+        full = numpy.zeros((self.count,) + rhs.shape[1:])
+        full[self.index] = rhs
+        result = self.lu.solve(full)
+        if len(self.capacitance):
+            result -= numpy.dot(self.solved, numpy.dot(
+                self.capacitance, numpy.dot(self.update.T, result)))
+        return result[self.index]
+
+
+def low_rank_update(base, network):
+    """a LowRankUpdate of `base` to solve `network` or None if `network`
+       isn't just `base` with lines or busses removed"""
+
+    bus_map = numpy.array([base.bus_index.get(x, -1) for x in network.bus_nos], int)
+    line_map = numpy.array([base.line_index.get(x, -1) 
+                            for x in network.line_ids], int)
+    if ((bus_map < 0).any() or (line_map < 0).any() or 
+        bus_map[network.slack] != base.slack):
+        return None
+
+    # the lines that are left must be unchanged
+    if not (numpy.array_equal(bus_map[network.fbus], base.fbus[line_map]) and
+            numpy.array_equal(bus_map[network.tbus], base.tbus[line_map]) and
+            numpy.array_equal(network.susceptance, base.susceptance[line_map]) and
+            numpy.array_equal(network.shift, base.shift[line_map])):
+        return None
+
+    lines = numpy.setdiff1d(numpy.arange(len(base.line_ids)), line_map)
+    busses = numpy.setdiff1d(numpy.arange(len(base.bus_nos)), bus_map)
+    return LowRankUpdate(base, bus_map[network.keep], lines, busses)
+
+
+def dc_power_flow(psat, base=None):
+    """func dc_power_flow :: PsatData -> PsatReport
+       ----
+       the DC power flow of `psat`, as a report that fails if a line is
+       over its limit. Raises Islanded if the network isn't whole.
+       With the `base` DCNetwork its factorisation is updated if it can.
+    """
+    network = DCNetwork(psat, base)
+    angles, flows = network.solve(network.injection(psat))
+    return network.report(psat, angles, flows)
+
+
+def dc_optimal_power_flow(psat, base=None):
+    """func dc_optimal_power_flow :: PsatData -> PsatReport
+       ----
+       the cheapest dispatch of `psat` without a line over its limit on
+       the DC network: a linear program using the ptdf. Each Supply.con
+       unit is bid from p_bid_min to p_bid_max at p_proportional and each
+       Demand.con the same (at a benefit of p_proportional), replacing
+       the PQ load at its bus. Other loads & shunts are fixed.
+       The report has the `dispatch` of each supply (by cid), the
+       `demand` at each Demand.con bus & its `cost`; it fails if there is
+       no such dispatch (then the powers are as they were). Raises
+       Islanded if the network isn't whole. `base` is as dc_power_flow.
+    """
+
+    network = DCNetwork(psat, base)
+    nbus = len(network.bus_nos)
+    index = network.bus_index
+    supplies = [supply for _, supply in sorted(psat.supply.items())]
+    demands = [demand for _, demand in sorted(psat.demand.items())]
+    bids = supplies + demands
+    sign = numpy.array([1.0] * len(supplies) + [-1.0] * len(demands))
+    at_bus = numpy.array([index[x.bus_no] for x in bids], int)
+
+    # the flows of the fixed loads (the slack supplying them) plus those
+    # of each bid sent to the slack; shunts aren't part of pl
+    fixed_load = numpy.zeros(nbus)
+    for load in psat.loads.values():
+        if load.bus_no not in psat.demand:
+            fixed_load[index[load.bus_no]] += load.p
+    fixed = fixed_load.copy()
+    for shunt in psat.shunts.values():
+        fixed[index[shunt.bus_no]] += shunt.g
+    _, fixed_flows = network.solve(-fixed)
+    ptdf = network.ptdf()[:, at_bus] * sign
+
+    limited = numpy.isfinite(network.limit).nonzero()[0]
+    a_ub = numpy.vstack((ptdf[limited], -ptdf[limited]))
+    b_ub = numpy.concatenate((network.limit[limited] - fixed_flows[limited],
+                              network.limit[limited] + fixed_flows[limited]))
+
+    cost = sign * [x.p_proportional for x in bids]
+    low = numpy.array([x.p_bid_min for x in bids], float)
+    high = numpy.array([x.p_bid_max for x in bids], float)
+    result = scipy.optimize.linprog(cost, a_ub if len(a_ub) else None,
+                                    b_ub if len(a_ub) else None,
+                                    sign[None, :], [fixed.sum()],
+                                    zip(low, high), method="interior-point")
+
+    if not result.success:
+        angles, flows = network.solve(network.injection(psat))
+        report = network.report(psat, angles, flows)
+        report.dispatch = {}
+        report.demand = {}
+        report.cost = None
+        report.acceptable = False
+        return report
+
+    dispatch = numpy.clip(result.x, low, high)
+    generation = numpy.bincount(at_bus, dispatch * (sign > 0), nbus)
+    demand = numpy.bincount(at_bus, dispatch * (sign < 0), nbus)
+    load = fixed_load + demand
+    angles, flows = network.solve(generation - fixed - demand)
+    report = network.report(psat, angles, flows)
+    for n, bus_no in enumerate(network.bus_nos):
+        report.power_flow[bus_no].pg = generation[n]
+        report.power_flow[bus_no].pl = load[n]
+    report.dispatch = dict((x.cid, p) for x, p in
+                           zip(supplies, dispatch[:len(supplies)]))
+    report.demand = dict((x.bus_no, p) for x, p in
+                         zip(demands, dispatch[len(supplies):]))
+    report.cost = numpy.dot(cost, dispatch)
+    # only the rounding of the solver can leave a line over its limit
+    report.overloads = [x for x in report.overloads if abs(x[1]) > x[2] + 1e-6]
+    report.acceptable = not report.overloads
+    return report
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_dc_power_flow(ModifiedTestCase):
+
+    text = """Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+3 138 1 0 2 1;
+];
+
+Line.con = [ ...
+1 2 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a1
+2 3 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a2
+1 3 100 138 60 0.0 0.0 0.0 0.2 0.0 0.0 0.0 0.0 0.0 1.0 1; %a3
+];
+
+SW.con = [ ...
+1 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+PV.con = [ ...
+2 100 138 0.5 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+PQ.con = [ ...
+3 100 138 1.5 0.10 1.05 0.95 1 1;
+];
+
+Supply.con = [ ...
+1 100 0.1 2.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+2 100 0.1 1.0 0.0 0 1.72 30.0 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""
+
+    def setUp(self):
+        self.psat = PsatData()
+        self.psat.read(StringIO(self.text))
+
+    def test_flows(self):
+        report = dc_power_flow(self.psat)
+        # angles: B = [[15, -10, -5], [-10, 20, -10], [-5, -10, 15]]
+        # solving for busses 2 & 3 with P = [0.5, -1.5]
+        theta2, theta3 = numpy.linalg.solve([[20, -10], [-10, 15]], [0.5, -1.5])
+        self.assertAlmostEqual(report.power_flow[2].phase, theta2)
+        self.assertAlmostEqual(report.power_flow[3].phase, theta3)
+        self.assertAlmostEqual(report.line_flow["a1"], -10 * theta2)
+        self.assertAlmostEqual(report.line_flow["a2"], 10 * (theta2 - theta3))
+        self.assertAlmostEqual(report.power_flow[1].pg, 1.0)
+        self.assertAlmostEqual(report.power_flow[2].pg, 0.5)
+        self.assertAlmostEqual(report.power_flow[3].pl, 1.5)
+        self.assertTrue(report.in_limit())
+
+    def test_shunt_round_trip(self):
+        import script
+        self.psat.read(StringIO("""Shunt.con = [ ...
+3 100 138 60 0.2 0.0 1;
+];"""))
+        report = dc_power_flow(self.psat)
+        self.assertAlmostEqual(report.power_flow[3].pl, 1.5)
+        self.assertAlmostEqual(report.power_flow[1].pg, 1.2)
+        psat = script.report_to_psat(report, self.psat)
+        self.assertAlmostEqual(psat.loads[3].p, 1.5)
+        self.assertAlmostEqual(psat.slack.values()[0].p_guess, 1.2)
+        self.assertAlmostEqual(dc_power_flow(psat).power_flow[1].pg, 1.2)
+
+    def test_limits(self):
+        self.assertEqual(line_limit(self.psat.lines["a1"]), 1.0)
+        line = self.psat.lines["a2"]
+        line.i_limit = 0.5
+        self.assertEqual(line_limit(line), 0.5)
+        report = dc_power_flow(self.psat)
+        self.assertFalse(report.in_limit())
+        self.assertEqual([x[0] for x in report.overloads], ["a2"])
+
+    def test_shift(self):
+        self.psat.lines["a3"].shift = math.degrees(0.1)
+        report = dc_power_flow(self.psat)
+        flows = report.line_flow
+        self.assertAlmostEqual(flows["a1"] + flows["a3"], 1.0)
+        self.assertAlmostEqual(flows["a3"],
+            5 * (report.power_flow[1].phase - report.power_flow[3].phase - 0.1))
+
+    def test_opf(self):
+        # all from g1 would put 0.75 on a3
+        self.psat.lines["a3"].s_limit = 0.6
+        report = dc_optimal_power_flow(self.psat)
+        self.assertTrue(report.in_limit())
+        g1, g2 = report.dispatch["g1"], report.dispatch["g2"]
+        self.assertAlmostEqual(g1 + g2, 1.5, 5)
+        self.assertAlmostEqual(report.line_flow["a3"], 0.6, 5)
+        self.assertAlmostEqual(report.power_flow[2].pg, g2)
+        self.assertAlmostEqual(report.cost, 24.8415 * g1 + 30.0 * g2, 4)
+        self.assertTrue(g2 > 0.1)
+
+    def test_opf_demand(self):
+        self.psat.read(StringIO("""Demand.con = [ ...
+3 100 1.5 0.1 1.5 1.0 0 0 28.0 0 0 0 0 0 0 0 0 1;
+];"""))
+        report = dc_optimal_power_flow(self.psat)
+        self.assertAlmostEqual(report.demand[3], 1.5, 5)
+        # g2 costs more than the demand is worth
+        self.psat.lines["a3"].s_limit = 0.6
+        report = dc_optimal_power_flow(self.psat)
+        self.assertTrue(report.in_limit())
+        self.assertAlmostEqual(report.demand[3], 1.2, 5)
+        self.assertAlmostEqual(report.dispatch["g1"], 1.2, 5)
+        self.assertAlmostEqual(report.power_flow[3].pl, 1.2, 5)
+
+    def test_opf_shunt(self):
+        import script
+        self.psat.read(StringIO("""Shunt.con = [ ...
+3 100 138 60 0.2 0.0 1;
+];"""))
+        report = dc_optimal_power_flow(self.psat)
+        self.assertAlmostEqual(report.power_flow[3].pl, 1.5)
+        self.assertAlmostEqual(report.dispatch["g1"] + report.dispatch["g2"],
+                               1.7, 5)
+        psat = script.report_to_psat(report, self.psat)
+        self.assertAlmostEqual(psat.loads[3].p, 1.5)
+        self.assertAlmostEqual(dc_power_flow(psat).power_flow[3].pl, 1.5)
+
+    def test_opf_infeasible(self):
+        self.psat.loads[3].p = 5.0
+        report = dc_optimal_power_flow(self.psat)
+        self.assertFalse(report.in_limit())
+        self.assertAlmostEqual(report.power_flow[2].pg, 0.5)
+
+    def test_low_rank(self):
+        base = DCNetwork(self.psat)
+        for busses, lines in (((), ("a3",)), ((3,), ()), ((), ())):
+            psat = self.psat.overlay()
+            psat.apply_removals(busses, lines, ())
+            network = DCNetwork(psat, base)
+            self.assertTrue(isinstance(network.lu, LowRankUpdate))
+            angles, flows = network.solve(network.injection(psat))
+            expected = dc_power_flow(psat)
+            self.assertEqual(network.line_ids, sorted(expected.line_flow))
+            for cid, flow in zip(network.line_ids, flows):
+                self.assertAlmostEqual(flow, expected.line_flow[cid])
+            for bus_no, angle in zip(network.bus_nos, angles):
+                self.assertAlmostEqual(angle, expected.power_flow[bus_no].phase)
+
+    def test_low_rank_changed(self):
+        base = DCNetwork(self.psat)
+        psat = self.psat.overlay()
+        writable(psat.lines, "a1").x = 0.2
+        self.assertFalse(isinstance(DCNetwork(psat, base).lu, LowRankUpdate))
+
+    def test_islanded(self):
+        self.psat.remove_line("a2")
+        self.psat.remove_line("a3")
+        self.assertRaises(Islanded, dc_power_flow, self.psat)
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+#==============================================================================
+#
+#==============================================================================
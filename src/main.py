@@ -8,6 +8,9 @@ from misc import Ensure, grem, as_csv
 from script import clean_files, simulate_scenario, report_to_psat, \
     batch_simulate, read_psat, read_probabilities, make_outage_cases, \
     make_failure_cases, text_to_scenario, report_in_limits
+from simulation_batch import SimulationBatch
+from symmetry import GeneratorSymmetry
+from sensitivity import LineSensitivity
 import math
 import sys
 import time
@@ -15,7 +18,8 @@ import cProfile
 import pstats
 
 
-def simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_file):
+def simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_file,
+                   backend="matlab"):
     clean_files()
 
     print "[C] simulate %d unique states with %d unique contingencies" % (
@@ -25,7 +29,7 @@ def simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_fil
     for n, scenario in enumerate(outage_batch):
         try:
             print "[C] simulating state", n + 1, "of", int(math.ceil(len(outage_batch)))
-            report = simulate_scenario(psat, scenario, False)
+            report = simulate_scenario(psat, scenario, False, backend)
             scenario_psat = report_to_psat(report, psat)
             clean_files()
             mismatch_file.write(as_csv("---- ---- ---- ---- ---- ----".split()) + "\n")
@@ -36,7 +40,14 @@ def simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_fil
             for x in failure_batch:
                 x.result = None
 
-            batch_simulate(failure_batch, scenario_psat, 100, True, mismatch_file)
+            # identical units are only identical with the same dispatch
+            symmetry = GeneratorSymmetry(scenario_psat)
+            # the dc result of line outages is quicker from the sensitivities
+            screen = None
+            if backend == "dc":
+                screen = LineSensitivity(scenario_psat)
+            batch_simulate(failure_batch, scenario_psat, 100, True, mismatch_file,
+                           symmetry=symmetry, backend=backend, screen=screen)
             
             filename = scenario.title + ".txt"
             with open(filename, "w") as result_file:
@@ -56,7 +67,60 @@ def simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_fil
             raise
 
 
-def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True):
+def adaptive_failure_cases(prob, psat, step, target_cov=None, 
+                           time_budget=None, batch_size=100, 
+                           mismatch_file=None, symmetry=None, backend="matlab",
+                           max_steps=1000):
+    """sample and simulate failures `step` at a time until the estimate 
+       of the probability of failure has a coefficient of variation of 
+       at most `target_cov` or `time_budget` seconds have passed. 
+       Only the new unique scenarios of each step are simulated.
+       It always stops after `max_steps` steps, as the CoV stays 
+       infinite while no failure has been sampled.
+    """
+    Ensure(target_cov or time_budget, "need a target CoV or time budget")
+    Ensure(max_steps > 0, "need at least one step")
+
+    timer_start = time.time()
+    batch = SimulationBatch()
+    cache = {}
+    current = 0
+    for _ in range(max_steps):
+        new_batch = SimulationBatch()
+        for scenario in prob.sample_failures(step, current):
+            new_batch.add(scenario)
+        current += step
+
+        batch_simulate(new_batch, psat, batch_size, True, mismatch_file, cache,
+                       symmetry, backend)
+        for scenario in new_batch:
+            batch.add(scenario)
+
+        prob_fail, err = batch.probability(lambda x: x.result == "fail")
+        cov = err / prob_fail if prob_fail else float("inf")
+        timer_time = time.time() - timer_start
+        print "[A] %d samples, %d unique, p(fail) = %g, CoV = %g, %d seconds" % (
+            batch.size(), len(batch), prob_fail, cov, int(timer_time))
+
+        if target_cov and cov <= target_cov:
+            break
+        if time_budget and timer_time >= time_budget:
+            print "[A] time budget reached before target CoV"
+            break
+    else:
+        print "[A] step limit reached before target CoV"
+    return batch
+
+
+def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True, 
+                   target_cov=None, time_budget=None, backend="matlab"):
+    """sample & simulate `n_outages` states and `n_failures` contingencies.
+       With a `target_cov` or `time_budget` the failures are instead 
+       sampled `n_failures` at a time until the failure probability is 
+       that accurate (see adaptive_failure_cases) or time runs out.
+       `backend` is "matlab" or one of script.backends ("dc" or "ac")
+       to simulate without Matlab.
+    """
     timer_begin = time.clock()
     timer_start = timer_begin
     print "[G] start simulation with %d states and %d contingencies." % (n_outages, n_failures)
@@ -68,6 +132,7 @@ def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True):
     batch_size = 100 
     psat = read_psat("rts.m")
     prob = read_probabilities("rts.net")
+    symmetry = GeneratorSymmetry(psat, prob)
     
 
     # create the base cases by sampling for outages 
@@ -84,7 +149,8 @@ def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True):
     try:
         if n_outages:
             outage_batch = make_outage_cases(prob, n_outages)
-            if sim: batch_simulate(outage_batch, psat, batch_size, True, mismatch_file)
+            if sim: batch_simulate(outage_batch, psat, batch_size, True, mismatch_file,
+                                   symmetry=symmetry, backend=backend)
     
             with open("outage.txt", "w") as result_file:
                 outage_batch.csv_write(result_file)
@@ -103,9 +169,18 @@ def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True):
             timer_start = time.clock()
         
         # do the same for one hour changes to the system.
-        if n_failures:
+        if n_failures and (target_cov or time_budget):
+            Ensure(sim, "adaptive sampling needs to simulate")
+            failure_batch = adaptive_failure_cases(prob, psat, n_failures, 
+                                                   target_cov, time_budget, 
+                                                   batch_size, mismatch_file,
+                                                   symmetry, backend)
+        elif n_failures:
             failure_batch = make_failure_cases(prob, n_failures)
-            if sim: batch_simulate(failure_batch, psat, batch_size, True, mismatch_file)
+            if sim: batch_simulate(failure_batch, psat, batch_size, True, mismatch_file,
+                                   symmetry=symmetry, backend=backend)
+
+        if n_failures:
     
             with open("failure.txt", "w") as result_file:
                 failure_batch.csv_write(result_file)
@@ -124,7 +199,8 @@ def generate_cases(n_outages=10, n_failures=1000, sim=True, full_sim=True):
     
         # simulate each of the changes to each base case
         if full_sim: 
-            simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_file)
+            simulate_cases(outage_batch, failure_batch, psat, summary_file, mismatch_file,
+                           backend)
         
             timer_end = time.clock()
             timer_time = (timer_end - timer_start)
@@ -34,7 +34,8 @@ import os
 import logging
 import itertools
 import traceback
-from collections import defaultdict
+import copy
+from collections import defaultdict, MutableMapping
 
 #==============================================================================
 # Logging:
@@ -194,6 +195,24 @@ class struct(object):
         """
         return as_csv([self.__dict__[x] for x in self.entries], " ")
 
+    def __reduce__(self):
+        """structs are often classes inside another class, which pickle 
+           can't find by name, so find them with struct_class"""
+        return (unpickle_struct, (self.__class__.__module__, 
+                                  self.__class__.__name__, self.__dict__))
+
+    def __copy__(self):
+        """quicker than copy.copy's default, which goes by __reduce__"""
+        item = object.__new__(self.__class__)
+        item.__dict__.update(self.__dict__)
+        return item
+
+    def __setattr__(self, name, value):
+        """any change makes the cached `row_text` (see 
+           psat_data.row_text) out of date"""
+        self.__dict__.pop("row_text", None)
+        object.__setattr__(self, name, value)
+
     def dict_fill(self, kwds):
         """fill in all 'entries' using the dict 'kwds'"""
         self.__dict__.update(kwds)
@@ -225,6 +244,29 @@ class struct(object):
         for member in self.entries:
             EnsureIn(member, dir(self), "entry not added")
 
+struct_classes = {}
+
+def struct_class(module_name, name):
+    """the struct class called `name` in the module `module_name`, either
+       at the top level or inside one of its classes"""
+    key = (module_name, name)
+    if key not in struct_classes:
+        module = __import__(module_name)
+        found = getattr(module, name, None)
+        if found is None:
+            for value in vars(module).values():
+                if isinstance(value, type) and isinstance(getattr(value, name, None), type):
+                    found = getattr(value, name)
+                    break
+        Ensure(found is not None, "no struct %s in %s" % (name, module_name))
+        struct_classes[key] = found
+    return struct_classes[key]
+
+def unpickle_struct(module_name, name, fields):
+    item = object.__new__(struct_class(module_name, name))
+    item.__dict__.update(fields)
+    return item
+
 def read_struct(class_type, cols):
     """read a list of strings as the data for 'class_type'
        e.g. read_struct(Bus, "101 0.025 13".split())
@@ -254,6 +296,146 @@ def TEST_struct():
 # TEST_struct()
 
 
+#==============================================================================
+#  OverlayDict: copy-on-write dict
+#==============================================================================
+
+class OverlayDict(MutableMapping):
+    """
+    A dict that shares the items of `base` until they are added, removed
+    or made `writable`; only those changes are stored. So making one is 
+    O(1) and using it is O(changes) rather than O(len(base)). 
+    
+    Items got by [] or values() are those of `base` and must not be 
+    changed, use `writable` (or the `writable` function) to get a copy
+    that is safe to change. `base` must not change while in use.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.changed = {}
+        self.removed = set()
+        self.size = len(base)
+
+    def __getitem__(self, key):
+        if key in self.changed:
+            return self.changed[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key in self.changed or (key not in self.removed and 
+                                       key in self.base)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.size += 1
+        self.changed[key] = value
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.changed.pop(key, None)
+        if key in self.base:
+            self.removed.add(key)
+        self.size -= 1
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.removed:
+                yield key
+        for key in self.changed:
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return self.size
+
+    def writable(self, key):
+        """self[key] copied into this overlay so that it can be changed"""
+        if key not in self.changed:
+            self.changed[key] = copy.copy(self[key])
+        return self.changed[key]
+
+
+def writable(items, key):
+    """items[key] that is safe to change, `items` may be an OverlayDict"""
+    if isinstance(items, OverlayDict):
+        return items.writable(key)
+    return items[key]
+
+def TEST_OverlayDict():
+    base = {1: [1], 2: [2], 3: [3]}
+    over = OverlayDict(base)
+    del over[1]
+    over[4] = [4]
+    writable(over, 2).append(5)
+    assert sorted(over.items()) == [(2, [2, 5]), (3, [3]), (4, [4])]
+    assert len(over) == 3 and 1 not in over
+    assert base == {1: [1], 2: [2], 3: [3]}
+
+# TEST_OverlayDict()
+
+
+#==============================================================================
+#  DisjointSet: union-find
+#==============================================================================
+
+class DisjointSet(object):
+    """
+    Union-find over hashable items, with path halving and union by size
+    so a sequence of `union` and `find` is near enough O(1) each.
+    Items are added when they are first used.
+    """
+
+    def __init__(self, items=()):
+        self.parent = {}
+        self.size = {}
+        for item in items:
+            self.find(item)
+
+    def find(self, item):
+        """the representative of the set containing `item`"""
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.size[item] = 1
+            return item
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, first, second):
+        """join the sets of `first` and `second`"""
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size.pop(second)
+
+    def groups(self):
+        """the sets as a list of lists"""
+        groups = defaultdict(list)
+        for item in self.parent:
+            groups[self.find(item)].append(item)
+        return groups.values()
+
+def TEST_DisjointSet():
+    sets = DisjointSet([1, 2, 3, 4, 5])
+    sets.union(1, 2)
+    sets.union(4, 3)
+    sets.union(2, 3)
+    assert sets.find(1) == sets.find(4) != sets.find(5)
+    assert sorted(sorted(x) for x in sets.groups()) == [[1, 2, 3, 4], [5]]
+
+# TEST_DisjointSet()
+
+
 
 #==============================================================================
 #  round_to:
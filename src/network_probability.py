@@ -28,13 +28,18 @@ network_probability.py NetworkProbability - prob_file - prob
 #==============================================================================
 
 from misc import struct, read_struct, as_csv, Ensure, Error
+from modifiedtestcase import ModifiedTestCase
 import random
 import math
 import sys
 import collections
+import heapq
+import cPickle
+import unittest
+import numpy
 from StringIO import StringIO
 
-from simulation_batch import Scenario
+from simulation_batch import Scenario, components as scenario_components
 import buslevel 
 
 #==============================================================================
@@ -173,6 +178,58 @@ class NetworkProbability(object):
         self.lines = []
         self.generators = []
         self.crows = []
+        self.pout_factor = 1.0
+        self.pfail_factor = 1.0
+        self.index()
+
+    def importance(self, pfail_factor=1.0, pout_factor=1.0):
+        """importance sampling: make `sample_failures` and `sample_outages`
+           kill each component with its probability multiplied by these
+           factors (to at most 0.5). The Scenarios they make then have a 
+           `weight` (the likelihood ratio) so that the estimates made by
+           SimulationBatch are still unbiased. Factors of 1 turn it off.
+        """
+        Ensure(pfail_factor > 0, "pfail_factor: " + str(pfail_factor))
+        Ensure(pout_factor > 0, "pout_factor: " + str(pout_factor))
+        self.pfail_factor = float(pfail_factor)
+        self.pout_factor = float(pout_factor)
+
+    def __setstate__(self, state):
+        """the component masks are only valid in the process that made
+           them (see simulation_batch.ComponentIndex)"""
+        self.__dict__.update(state)
+        if "components" in state:
+            self.component_masks = [scenario_components.bit(kind, name)
+                                    for kind, name in self.components]
+
+    def index(self):
+        """build the probability vectors used by the batch samplers.
+           there is one column per component: all the busses, then all 
+           the lines, then all the generators (each in the order read).
+        """
+        self.components = ([("bus", x.bus_id) for x in self.busses] + 
+                           [("line", x.name) for x in self.lines] + 
+                           [("generator", x.name) for x in self.generators])
+        self.component_masks = [scenario_components.bit(kind, name)
+                                for kind, name in self.components]
+        components = self.busses + self.lines + self.generators
+        self.pout_vector = numpy.array([x.pout for x in components], float)
+        self.pfail_vector = numpy.array([x.pfail for x in components], float)
+
+        # crows by the line that triggers them, and as columns for `sample`
+        # (a crow on a line we don't have can never be sampled).
+        self.crow_index = collections.defaultdict(list)
+        for crow in self.crows:
+            self.crow_index[crow.line1].append(crow)
+
+        line_column = dict((line.name, len(self.busses) + n)
+                           for n, line in enumerate(self.lines))
+        crows = [crow for crow in self.crows 
+                 if crow.line1 in line_column and crow.line2 in line_column]
+        self.crow_from = numpy.array([line_column[x.line1] for x in crows], int)
+        self.crow_to = numpy.array([line_column[x.line2] for x in crows], int)
+        self.crow_probability = numpy.array([x.probability for x in crows], 
+                                            float)
 
     def read(self, stream):
         for line in stream:
@@ -193,6 +250,7 @@ class NetworkProbability(object):
                 self.crows.append(read_struct(self.Crow, cols[1:]))
             else:
                 raise Error("expected (bus, line, generator, crow) got " + cols[0])
+        self.index()
 
     def write(self, stream):
         stream.write("# NetworkProbability data file\n")
@@ -216,11 +274,10 @@ class NetworkProbability(object):
     def crow_fails(self, linekill):
         crowfails = []
         for kill in linekill:
-            for crow in self.crows:
-                if crow.line1 == kill:
-                    if fail(crow.probability):
-                        # print "crow fail:", crow.line1, kill
-                        crowfails.append(crow.line2)
+            for crow in self.crow_index.get(kill, []):
+                if fail(crow.probability):
+                    # print "crow fail:", crow.line1, kill
+                    crowfails.append(crow.line2)
         return crowfails
 
     def outages(self, name):
@@ -254,6 +311,186 @@ class NetworkProbability(object):
 
         return scen
 
+    def sample(self, count, pkill, factor=1.0):
+        """a (count x components) boolean matrix, True where a component
+           is killed, and the likelihood ratio of each row. Each component
+           is killed with probability `pkill` (one of the vectors made by
+           `index`) times `factor` followed by crow fails.
+        """
+        # the biased probability can go up to 0.5 (never down from `pkill`)
+        # and a certain failure stays certain.
+        biased = numpy.minimum(pkill * factor, numpy.maximum(pkill, 0.5))
+        biased[pkill >= 1] = 1.0
+        kills = numpy.random.random((count, len(pkill))) < biased
+
+        # the ratio depends only on the independent kills as the crow fails
+        # have the same probability whether we bias or not.
+        weight = numpy.ones(count)
+        changed = (biased != pkill)
+        if changed.any():
+            p, q = pkill[changed], biased[changed]
+            dead = numpy.log(p / q)
+            alive = numpy.log((1 - p) / (1 - q))
+            weight = numpy.exp(alive.sum() + 
+                               kills[:, changed].dot(dead - alive))
+
+        # only rows where a crow's first line failed can have a crow fail
+        triggered = kills[:, self.crow_from]
+        rows = triggered.any(axis=1).nonzero()[0]
+        if len(rows):
+            draw = numpy.random.random((len(rows), len(self.crow_from)))
+            trip = triggered[rows] & (draw < self.crow_probability)
+            row, crow = trip.nonzero()
+            kills[rows[row], self.crow_to[crow]] = True
+
+        return kills, weight
+
+    def kill_columns(self, scen, columns):
+        """add the components of `columns` to the kill lists of `scen`"""
+        for column in columns:
+            scen.mask |= self.component_masks[column]
+
+    def make_scenarios(self, prefix, simtype, kills, weight, demand, start=0):
+        """make one Scenario per distinct row of `kills` & `demand`; its 
+           count is the number of times the row was sampled and its weight
+           the mean `weight` of those rows. They are titled by `prefix` 
+           and the index of the row it first occured (counting from 
+           `start`).
+        """
+        if len(kills) == 0:
+            return []
+
+        # each row packed into a single byte string so that `unique` is
+        # a fast 1d sort rather than a comparison of every column.
+        demand = numpy.asarray(demand, float)
+        rows = numpy.column_stack((numpy.packbits(kills, axis=1), 
+                                   demand.view(numpy.uint8).reshape(-1, 8)))
+        rows = numpy.ascontiguousarray(rows)
+        keys = rows.view(numpy.dtype((numpy.void, rows.shape[1]))).ravel()
+        _, first, inverse, counts = numpy.unique(keys, return_index=True, 
+                                                 return_inverse=True,
+                                                 return_counts=True)
+        weights = numpy.bincount(inverse, weight) / counts
+        scenarios = []
+        for n in numpy.argsort(first):
+            row = first[n]
+            scen = Scenario(prefix + str(start + row), simtype, int(counts[n]))
+            self.kill_columns(scen, kills[row].nonzero()[0])
+            scen.all_demand = float(demand[row])
+            scen.weight = float(weights[n])
+            scenarios.append(scen)
+        return scenarios
+
+    def sample_outages(self, count, start=0):
+        """like `outages` but for `count` samples at once. Returns a list
+           of Scenarios, one for each distinct sample, with their count
+           set. The titles are numbered from `start`.
+        """
+        kills, weight = self.sample(count, self.pout_vector, self.pout_factor)
+        demand = buslevel.forecast_demand.sample(count)
+        return self.make_scenarios("outage", "opf", kills, weight, demand, 
+                                   start)
+
+    def sample_failures(self, count, start=0):
+        """like `failures` but for `count` samples at once. Returns a 
+           list of Scenarios, one for each distinct sample, with their 
+           count set. The titles are numbered from `start`.
+        """
+        kills, weight = self.sample(count, self.pfail_vector, 
+                                    self.pfail_factor)
+        demand = buslevel.actual_demand.sample(count)
+        return self.make_scenarios("failure", "pf", kills, weight, demand, 
+                                   start)
+
+    def enumerate_states(self, pkill):
+        """generate every state of the components, as the list of killed
+           columns and its exact probability, in decreasing probability.
+           Each component is killed independently with probability 
+           `pkill`; crow fails aren't included.
+
+           Each component has a likely state; flipping it to the other 
+           multiplies the probability of a state by `ratio` (<= 1). With
+           the ratios sorted, a state's children are made by flipping the
+           next component or moving its last flip on one, so each state 
+           is made once and only after its parent.
+        """
+        certain = [n for n, p in enumerate(pkill) if p >= 1]
+        uncertain = [n for n, p in enumerate(pkill) if 0 < p < 1]
+
+        unlikely = [min(pkill[n], 1 - pkill[n]) for n in uncertain]
+        base = 1.0
+        for n in uncertain:
+            base *= max(pkill[n], 1 - pkill[n])
+
+        # flipping a component kills it if it is likely to be alive
+        ratio = [p / (1 - p) for p in unlikely]
+        order = sorted(range(len(uncertain)), key=lambda n: -ratio[n])
+        ratio = [ratio[n] for n in order]
+        columns = [uncertain[n] for n in order]
+        killed = [pkill[n] >= 0.5 for n in columns]
+
+        def state(flips):
+            dead = set(certain)
+            dead.update(n for n, kill in zip(columns, killed) if kill)
+            for idx in flips:
+                dead.symmetric_difference_update([columns[idx]])
+            return sorted(dead)
+
+        heap = [(-base, ())]
+        while heap:
+            prob, flips = heapq.heappop(heap)
+            yield state(flips), -prob
+
+            last = flips[-1] if flips else -1
+            if last + 1 < len(ratio):
+                heapq.heappush(heap, (prob * ratio[last + 1], 
+                                      flips + (last + 1,)))
+                if flips:
+                    heapq.heappush(heap, (prob * ratio[last + 1] / ratio[last],
+                                          flips[:-1] + (last + 1,)))
+
+    def contingencies(self, coverage=0.99, limit=None, outages=False, 
+                      demand=False):
+        """func contingencies :: UnitReal, Int, Bool, Bool -> [Scenario]
+           ----
+           the most probable failure states (or outage states if 
+           `outages`), in decreasing order, until their total probability
+           reaches `coverage` or there are `limit` of them. Each Scenario 
+           has its exact `probability` set and no demand change. 
+           With `demand` each state is instead repeated for every demand
+           level (as sampled by `failures` or `outages`) with the exact 
+           probability of both.
+        """
+        Ensure(0 < coverage <= 1, "coverage: " + str(coverage))
+        if outages:
+            pkill, prefix, simtype = self.pout_vector, "outage", "opf"
+            levels = buslevel.forecast_demand
+        else:
+            pkill, prefix, simtype = self.pfail_vector, "contingency", "pf"
+            levels = buslevel.actual_demand
+
+        if demand:
+            levels = zip(levels.values, levels.probabilities)
+        else:
+            levels = [(None, 1.0)]
+
+        scenarios = []
+        covered = 0.0
+        states = 0
+        for columns, prob in self.enumerate_states(pkill):
+            for level, level_prob in levels:
+                scen = Scenario(prefix + str(len(scenarios)), simtype)
+                self.kill_columns(scen, columns)
+                if level is not None:
+                    scen.all_demand = float(level)
+                scen.probability = prob * level_prob
+                scenarios.append(scen)
+            covered += prob
+            states += 1
+            if covered >= coverage or states == limit:
+                break
+        return scenarios
+
     def write_stats(self, stream):
         
         Ensure(len(self.busses), "There must be more than one bus. Got %d" % len(self.busses))
@@ -396,3 +633,133 @@ def TEST_bus_level_quantise():
     print "-" * 80
 
 # TEST_bus_level_quantise()
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_sample(ModifiedTestCase):
+
+    def setUp(self):
+        self.prob = NetworkProbability()
+        self.prob.read(StringIO("""
+bus 101 0.0 10.0
+bus 102 0.0 10.0
+bus 103 0.0 10.0
+line a1 101 102 100000000000.0 10.0 0.0
+line a2 102 103 0.0 10.0 0.0
+line a3 101 103 0.0 10.0 0.0
+generator g1 101 -1 -1 u20
+crow a1 a2 1.0
+"""))
+
+    def test_vectors(self):
+        self.assertEqual(len(self.prob.components), 7)
+        self.assertEqual(self.prob.components[3], ("line", "a1"))
+        self.assertAlmostEqualList(self.prob.pfail_vector, 
+                                   [0, 0, 0, 1, 0, 0, 0])
+
+    def test_outages(self):
+        scenarios = self.prob.sample_outages(100)
+        self.assertEqual(len(scenarios), len(set(x.dicthash() for x in scenarios)))
+        self.assertEqual(sum(x.count for x in scenarios), 100)
+        for scen in scenarios:
+            self.assertEqual(scen.simtype, "opf")
+            self.assertEqual(scen.kill_bus, [])
+            self.assertEqual(scen.kill_gen, [])
+            self.assertEqual(scen.kill_line, ["a1", "a2"])
+
+    def test_failures(self):
+        scenarios = self.prob.sample_failures(1000, 10)
+        self.assertEqual(sum(x.count for x in scenarios), 1000)
+        self.assertEqual(scenarios[0].title, "failure10")
+        for scen in scenarios:
+            self.assertEqual(scen.simtype, "pf")
+            self.assertEqual(scen.kill_line, ["a1", "a2"])
+            self.assertEqual(scen.all_demand, buslevel.quantised_05(scen.all_demand))
+
+    def test_empty(self):
+        self.assertEqual(self.prob.sample_failures(0), [])
+
+    def test_pickle(self):
+        prob = cPickle.loads(cPickle.dumps(self.prob, 2))
+        self.assertEqual(prob.components, self.prob.components)
+        self.assertEqual(prob.component_masks, self.prob.component_masks)
+        streams = StringIO(), StringIO()
+        prob.write(streams[0])
+        self.prob.write(streams[1])
+        self.assertEqual(streams[0].getvalue(), streams[1].getvalue())
+
+    def test_crow_index(self):
+        self.assertEqual(self.prob.crow_fails(["a1"]), ["a2"])
+        self.assertEqual(self.prob.crow_fails(["a2", "a3"]), [])
+        self.assertEqual(list(self.prob.crow_from), [3])
+        self.assertEqual(list(self.prob.crow_to), [4])
+
+    def test_crow_probability(self):
+        self.prob.crows[0].probability = 0.5
+        self.prob.index()
+        kills, _ = self.prob.sample(10000, self.prob.pfail_vector)
+        self.assertEqual(kills[:, 3].sum(), 10000)
+        self.assertTrue(4500 < kills[:, 4].sum() < 5500)
+        self.assertEqual(kills[:, 5].sum(), 0)
+
+    def test_enumerate(self):
+        pkill = numpy.array([0.1, 0.0, 0.2, 1.0, 0.7])
+        states = list(self.prob.enumerate_states(pkill))
+        self.assertEqual(len(states), 8)
+        self.assertAlmostEqual(sum(prob for _, prob in states), 1.0)
+        probs = [prob for _, prob in states]
+        self.assertEqual(probs, sorted(probs, reverse=True))
+        self.assertEqual(states[0][0], [3, 4])
+        self.assertAlmostEqual(states[0][1], 0.9 * 0.8 * 0.7)
+        self.assertEqual(states[1][0], [3])
+        self.assertAlmostEqual(states[1][1], 0.9 * 0.8 * 0.3)
+        self.assertEqual(len(set(tuple(x) for x, _ in states)), 8)
+
+    def test_contingencies(self):
+        self.prob.lines[1].pfail = 0.01
+        self.prob.generators[0].pfail = 0.02
+        self.prob.index()
+        scenarios = self.prob.contingencies(1.0)
+        self.assertEqual([x.kill_gen for x in scenarios], [[], ["g1"], [], ["g1"]])
+        self.assertEqual([x.kill_line for x in scenarios], 
+                         [["a1"], ["a1"], ["a1", "a2"], ["a1", "a2"]])
+        self.assertAlmostEqual(scenarios[0].probability, 0.99 * 0.98)
+        self.assertEqual(len(self.prob.contingencies(0.5)), 1)
+        self.assertEqual(len(self.prob.contingencies(1.0, 2)), 2)
+
+        scenarios = self.prob.contingencies(0.5, demand=True)
+        self.assertEqual(len(scenarios), len(buslevel.actual_demand.values))
+        self.assertAlmostEqual(sum(x.probability for x in scenarios), 
+                               0.99 * 0.98)
+        self.assertEqual(set(x.all_demand for x in scenarios), 
+                         set(buslevel.actual_demand.values))
+
+    def test_importance(self):
+        self.prob.generators[0].pfail = 0.002
+        self.prob.index()
+        self.prob.importance(20.0)
+        count = 20000
+        scenarios = self.prob.sample_failures(count)
+        self.assertEqual(sum(x.count for x in scenarios), count)
+
+        # `g1` is found 20x as often but its estimate is unbiased.
+        found = sum(x.count for x in scenarios if "g1" in x.kill_gen)
+        self.assertTrue(0.02 < found / float(count) < 0.06)
+        estimate = sum(x.count * x.weight for x in scenarios 
+                       if "g1" in x.kill_gen) / count
+        self.assertTrue(0.0015 < estimate < 0.0025)
+        total = sum(x.count * x.weight for x in scenarios) / count
+        self.assertAlmostEqual(total, 1.0, 1)
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
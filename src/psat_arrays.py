@@ -0,0 +1,573 @@
+#! /usr/local/bin/python
+# psat_arrays.py - PsatArrays
+
+#==============================================================================
+# Copyright (C) 2010 James Brooks (kerspoon)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANDABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#==============================================================================
+
+"""
+by James Brooks 2010
+psat_arrays.py - PsatArrays
+"""
+
+#==============================================================================
+#  Imports:
+#==============================================================================
+
+from misc import as_csv, Ensure, EnsureEqual, EnsureIn
+from psat_data import PsatData, fix_mismatch, fix_mismatches, read_columns, islanding
+from modifiedtestcase import ModifiedTestCase
+from StringIO import StringIO
+import numpy
+import unittest
+
+#==============================================================================
+#
+#==============================================================================
+
+dtypes = {"int": numpy.int64, "real": numpy.float64}
+
+
+def section_dtype(classtype, width=1):
+    """the fields of `classtype`; strings (cids) are `width` long so
+       they must be sized from the longest one that will be stored"""
+    return [(name, dtypes[kind] if kind != "str" else "S%d" % max(width, 1))
+            for name, kind in zip(classtype.entries, classtype.types)]
+
+
+def section_array(items, classtype):
+    """the structs in the dict `items` as a structured array in the order
+       of their keys (the order they are written in)"""
+    rows = [tuple(getattr(item, x) for x in classtype.entries)
+            for _, item in sorted(items.items())]
+    strings = [n for n, kind in enumerate(classtype.types) if kind == "str"]
+    width = max([len(row[n]) for row in rows for n in strings] or [1])
+    return numpy.array(rows, dtype=section_dtype(classtype, width))
+
+
+def columns_array(values, cids, classtype):
+    """a section from read_columns as a structured array in key order"""
+    width = max([len(cid) for cid in cids] or [1]) if cids is not None else 1
+    array = numpy.zeros(len(values), section_dtype(classtype, width))
+    numbers = classtype.entries[:-1] if cids is not None else classtype.entries
+    Ensure(len(values) == 0 or values.shape[1] == len(numbers),
+           "incomplete info for " + classtype.__name__)
+    for n, name in enumerate(numbers):
+        array[name] = values[:, n]
+    if cids is not None:
+        array["cid"] = cids
+        return array[numpy.argsort(array["cid"], kind="mergesort")]
+    return array[numpy.argsort(array["bus_no"], kind="mergesort")]
+
+
+def row_text(classtype, row):
+    """the same as psat_data.row_text for a row (as a tuple)"""
+    if "cid" == classtype.entries[-1]:
+        return "  " + as_csv(row[:-1], " ") + "; %" + row[-1] + "\n"
+    return "  " + as_csv(row, " ") + ";\n"
+
+
+class PsatArrays(object):
+    """
+    A columnar PsatData: each section is a structured numpy array (with
+    the same fields as the PsatData struct) and a boolean `alive` mask
+    rather than a dict of structs. Removing components only clears their
+    mask and the other changes are vectorised.
+
+    It has the same methods as PsatData that are used to make a scenario
+    (see script.scenario_to_psat) so it can be used in its place. Copies
+    (from `overlay`) share the arrays until they change one of them.
+    The text of the rows of the original arrays is only made once, so
+    writing a copy only formats the rows it changed.
+    """
+
+    sections = [("busses", PsatData.Bus, "Bus"),
+                ("lines", PsatData.Line, "Line"),
+                ("slack", PsatData.Slack, "SW"),
+                ("generators", PsatData.Generator, "PV"),
+                ("loads", PsatData.Load, "PQ"),
+                ("shunts", PsatData.Shunt, "Shunt"),
+                ("demand", PsatData.Demand, "Demand"),
+                ("supply", PsatData.Supply, "Supply")]
+
+    def __init__(self, psat=None):
+        self.alive = {}
+        self.owned = set()
+        self.mismatch = 0.0
+        self.base = {}
+        self.text = {}
+        if psat is not None:
+            for name, classtype, _ in self.sections:
+                array = section_array(getattr(psat, name), classtype)
+                setattr(self, name, array)
+                self.alive[name] = numpy.ones(len(array), bool)
+                self.base[name] = array
+            self.mismatch = psat.mismatch
+            self.index()
+
+    def read(self, stream):
+        """read a Matlab file (see psat_data.read_columns) straight into
+           arrays without making a PsatData; `to_psat` makes the structs
+           if they are needed."""
+        titles = dict((title, (name, classtype)) for 
+                      name, classtype, title in self.sections)
+        for name, classtype, _ in self.sections:
+            setattr(self, name, numpy.zeros(0, section_dtype(classtype)))
+
+        for title, values, cids in read_columns(stream):
+            EnsureIn(title, titles, "unknown matlab section")
+            name, classtype = titles[title]
+            setattr(self, name, columns_array(values, cids, classtype))
+
+        for name, _, _ in self.sections:
+            self.base[name] = getattr(self, name)
+            self.alive[name] = numpy.ones(len(self.base[name]), bool)
+        self.owned = set()
+        self.index()
+
+    def index(self):
+        """row lookups, shared by all copies as rows never move"""
+        self.virtual = numpy.array([cid.startswith("c") for cid in
+                                    self.lines["cid"]], bool)
+        self.supply_row = dict((cid, n) for n, cid in
+                               enumerate(self.supply["cid"]))
+        self.generator_row = dict((bus_no, n) for n, bus_no in
+                                  enumerate(self.generators["bus_no"]))
+        demand_row = dict((bus_no, n) for n, bus_no in
+                          enumerate(self.demand["bus_no"]))
+        self.demand_of_load = numpy.array([demand_row.get(bus_no, -1) for
+                                           bus_no in self.loads["bus_no"]],
+                                          int)
+
+    def overlay(self):
+        """a copy that shares the arrays of this one until it changes
+           them; only the alive masks are copied."""
+        new = PsatArrays()
+        new.__dict__.update(self.__dict__)
+        new.alive = dict((name, alive.copy())
+                         for name, alive in self.alive.items())
+        new.owned = set()
+        return new
+
+    def writable(self, name):
+        """the array of section `name`, copied first if it is shared"""
+        if name not in self.owned:
+            setattr(self, name, getattr(self, name).copy())
+            self.owned.add(name)
+        return getattr(self, name)
+
+    def live(self, name):
+        return getattr(self, name)[self.alive[name]]
+
+    def base_text(self, name, classtype):
+        """the text of each row of the original array of `name`"""
+        if name not in self.text:
+            rows = [row_text(classtype, row) for row in 
+                    self.base[name].tolist()]
+            self.text[name] = numpy.array(rows, object)
+        return self.text[name]
+
+    def write(self, stream):
+        """the same as PsatData.write (as a single write)"""
+        parts = []
+        for name, classtype, title in self.sections:
+            alive = self.alive[name]
+            if not alive.any():
+                continue
+            lines = self.base_text(name, classtype)
+            array = getattr(self, name)
+            if array is not self.base[name]:
+                changed = ((array != self.base[name]) & alive).nonzero()[0]
+                if len(changed):
+                    lines = lines.copy()
+                    for n in changed:
+                        lines[n] = row_text(classtype, array[n].tolist())
+            parts.append(title + ".con = [ ... \n")
+            parts.extend(lines[alive])
+            parts.append("];\n\n")
+        stream.write("".join(parts))
+
+    def to_psat(self):
+        """the PsatData of what is alive"""
+        psat = PsatData()
+        for name, classtype, _ in self.sections:
+            items = getattr(psat, name)
+            for row in self.live(name).tolist():
+                item = classtype(dict(zip(classtype.entries, row)))
+                if "cid" == classtype.entries[-1]:
+                    items[item.cid] = item
+                else:
+                    items[item.bus_no] = item
+        psat.mismatch = self.mismatch
+        psat.index()
+        return psat
+
+    def remove_bus(self, bus_no):
+        self.apply_removals(buses=[bus_no])
+
+    def remove_line(self, line_id):
+        self.apply_removals(lines=[line_id])
+
+    def apply_removals(self, buses=(), lines=(), generators=()):
+        """the same as PsatData.apply_removals"""
+
+        line_cids = set(self.live("lines")["cid"]) if len(lines) else ()
+        for cid in lines:
+            if cid not in line_cids:
+                raise KeyError(cid)
+        supply_alive = self.alive["supply"].copy()
+        for supply_id in generators:
+            if not supply_alive[self.supply_row[supply_id]]:
+                raise KeyError(supply_id)
+
+        bus_alive = self.alive["busses"]
+        bus_no = self.busses["bus_no"]
+        dead = set(buses)
+        EnsureEqual(len(dead),
+                    numpy.count_nonzero(bus_alive & numpy.in1d(bus_no, list(dead))),
+                    "missing bus in %s" % sorted(dead))
+
+        # grow the dead busses along the virtual ("c") lines
+        line_alive = self.alive["lines"]
+        fbus, tbus = self.lines["fbus"], self.lines["tbus"]
+        virtual = self.virtual & line_alive
+        while dead:
+            at = numpy.in1d(fbus, list(dead)) | numpy.in1d(tbus, list(dead))
+            ends = set(fbus[virtual & at]) | set(tbus[virtual & at])
+            if ends <= dead:
+                break
+            dead |= ends
+
+        if dead:
+            slack_bus = self.live("slack")["bus_no"]
+            if len(slack_bus) == 1:
+                Ensure(slack_bus[0] not in dead,
+                       "can't remove the slack bus %d" % slack_bus[0])
+            else:
+                print "Expected one slack got %d" % len(slack_bus)
+
+            dead = list(dead)
+            line_alive &= ~(numpy.in1d(fbus, dead) | numpy.in1d(tbus, dead))
+            bus_alive &= ~numpy.in1d(bus_no, dead)
+            for name in ["shunts", "demand", "supply"]:
+                self.alive[name] &= ~numpy.in1d(getattr(self, name)["bus_no"], dead)
+
+            gone = self.alive["generators"] & numpy.in1d(self.generators["bus_no"], dead)
+            self.mismatch -= self.generators["p"][gone].sum()
+            self.alive["generators"] &= ~gone
+
+            gone = self.alive["loads"] & numpy.in1d(self.loads["bus_no"], dead)
+            self.mismatch += self.loads["p"][gone].sum()
+            self.alive["loads"] &= ~gone
+
+        if len(lines):
+            line_alive &= ~numpy.in1d(self.lines["cid"], list(lines))
+
+        for supply_id in generators:
+            if self.alive["supply"][self.supply_row[supply_id]]:
+                self.remove_generator(supply_id)
+
+    def remove_generator(self, supply_id):
+        """the same as PsatData.remove_generator"""
+        row = self.supply_row[supply_id]
+        EnsureEqual(self.alive["supply"][row], True, "dead supply " + supply_id)
+        bus_no = self.supply["bus_no"][row]
+        slacks = self.alive["slack"].nonzero()[0]
+
+        if len(slacks) and self.slack["bus_no"][slacks[0]] == bus_no:
+            EnsureEqual(len(slacks), 1)
+            slack = self.writable("slack")[slacks[0]]
+            self.mismatch -= slack["p_guess"]
+            self.alive["supply"][row] = False
+
+            gen = None
+            for x in [37, 38]:
+                if x in self.generator_row and self.alive["generators"][self.generator_row[x]]:
+                    gen = self.generators[self.generator_row[x]]
+                    break
+            Ensure(gen is not None, "no slack bus")
+
+            for field, value in [("bus_no", gen["bus_no"]),
+                                 ("s_rating", gen["s_rating"]),
+                                 ("v_rating", gen["v_rating"]),
+                                 ("v_magnitude", gen["v"]),
+                                 ("ref_angle", 0.0),
+                                 ("q_max", gen["q_max"]),
+                                 ("q_min", gen["q_min"]),
+                                 ("v_max", gen["v_max"]),
+                                 ("v_min", gen["v_min"]),
+                                 ("p_guess", gen["p"]),
+                                 ("lp_coeff", gen["lp_coeff"]),
+                                 ("ref_bus", 1.0),
+                                 ("status", gen["status"])]:
+                slack[field] = value
+            self.alive["generators"][self.generator_row[gen["bus_no"]]] = False
+        else:
+            EnsureIn(bus_no, self.generator_row, "missing generator info")
+            gen_row = self.generator_row[bus_no]
+            Ensure(self.alive["generators"][gen_row], "missing generator info")
+            self.mismatch -= self.generators["p"][gen_row]
+            self.alive["generators"][gen_row] = False
+            self.alive["supply"][row] = False
+
+    def set_all_demand(self, value):
+        """the same as PsatData.set_all_demand"""
+        Ensure(0 < value <= 4, "just a vague sanity check")
+
+        alive = self.alive["loads"]
+        rows = self.demand_of_load[alive]
+        Ensure((rows >= 0).all(), "a load has no demand")
+        loads = self.writable("loads")
+        demand = self.writable("demand")
+        old = loads["p"][alive]
+        new = old * value
+        self.mismatch += (old - new).sum()
+        loads["p"][alive] = new
+        demand["p_bid_max"][rows] = new
+        demand["p_bid_min"][rows] = new
+
+    def bid_limits(self, bus_nos):
+        """the sum of the min and max bids of the supply at each bus"""
+        supply = self.live("supply")
+        size = 1 + max([0] + list(supply["bus_no"]) + list(bus_nos))
+        low = numpy.bincount(supply["bus_no"], supply["p_bid_min"], size)
+        high = numpy.bincount(supply["bus_no"], supply["p_bid_max"], size)
+        return low[bus_nos], high[bus_nos]
+
+    def dispatch(self):
+        """the power and bid limits of each generator then the slack"""
+        generators, slack = self.live("generators"), self.live("slack")
+        bus_nos = numpy.concatenate((generators["bus_no"], slack["bus_no"]))
+        power = numpy.concatenate((generators["p"], slack["p_guess"]))
+        low, high = self.bid_limits(bus_nos)
+        return power, low, high
+
+    def units(self):
+        """the same as PsatData.units"""
+        return ([("generator", x) for x in self.live("generators")["bus_no"].tolist()] + 
+                [("slack", x) for x in self.live("slack")["bus_no"].tolist()])
+
+    def unit_dispatch(self, units):
+        """the same as PsatData.unit_dispatch"""
+        power, _, _ = self.dispatch()
+        powers = dict(zip(self.units(), power.tolist()))
+        low, high = self.bid_limits(numpy.array([x for _, x in units], int))
+        return (numpy.array([powers.get(unit, 0.0) for unit in units], float),
+                low, high, numpy.array([unit in powers for unit in units], bool))
+
+    def set_generator_power(self, units, power):
+        """the same as PsatData.set_generator_power"""
+        alive = self.alive["generators"]
+        generators = self.writable("generators")
+        for (kind, bus_no), newp in zip(units, power):
+            row = self.generator_row.get(bus_no)
+            if kind == "generator" and row is not None and alive[row]:
+                generators["p"][row] = newp
+
+    def get_stats(self):
+        """the same as PsatData.get_stats"""
+        power, low, high = self.dispatch()
+        return (self.mismatch, power.sum(), self.live("loads")["p"].sum(),
+                low.sum(), high.sum())
+
+    def fix_mismatch(self):
+        """the same as PsatData.fix_mismatch"""
+        if self.mismatch != 0:
+            power, low, high = self.dispatch()
+            res = fix_mismatch(-self.mismatch, list(power), list(low), list(high))
+            alive = self.alive["generators"]
+            generators = self.writable("generators")
+            generators["p"][alive] = res[:numpy.count_nonzero(alive)]
+
+        Ensure(self.in_limits(), "fixing mismatch should leave it in limit")
+
+    def in_limits(self):
+        """the same as PsatData.in_limits"""
+        generators = self.live("generators")
+        low, high = self.bid_limits(generators["bus_no"])
+        p, v = generators["p"], generators["v"]
+        power_ok = (p == 0) | ((low <= p) & (p <= high))
+        volt_ok = (generators["v_min"] <= v) & (v <= generators["v_max"])
+        for n in (~power_ok).nonzero()[0]:
+            print "generator", generators["bus_no"][n], "power limit:",
+            print low[n], "<=", p[n], "<=", high[n]
+        for n in (~volt_ok).nonzero()[0]:
+            print "generator", generators["bus_no"][n], "volt limit:",
+            print generators["v_min"][n], "<=", v[n], "<=", generators["v_max"][n]
+
+        slack = self.live("slack")
+        slack_ok = ((slack["v_min"] <= slack["v_magnitude"]) &
+                    (slack["v_magnitude"] <= slack["v_max"]))
+        for n in (~slack_ok).nonzero()[0]:
+            print "slack", slack["bus_no"][n], "volt limit:",
+            print slack["v_min"][n], "<=", slack["v_magnitude"][n], "<=", slack["v_max"][n]
+
+        return bool(power_ok.all() and volt_ok.all() and slack_ok.all())
+
+    def islanding(self):
+        """the same as PsatData.islanding"""
+        lines = self.live("lines")
+        return islanding(self.live("busses")["bus_no"].tolist(),
+                         zip(lines["fbus"].tolist(), lines["tbus"].tolist()),
+                         self.live("slack")["bus_no"].tolist(),
+                         self.live("supply")["bus_no"].tolist(),
+                         self.live("loads")["bus_no"].tolist() + 
+                         self.live("demand")["bus_no"].tolist())
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_psat_arrays(ModifiedTestCase):
+
+    text = """Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+3 138 1 0 2 1;
+11 138 1 0 2 1;
+12 138 1 0 2 1;
+];
+
+Line.con = [ ...
+1 2 100 138 60 0.0 0.0 0.0026 0.0139 0.4611 0.0 0.0 1.93 0.0 2.0 1; %a1
+2 3 100 138 60 0.0 0.0 0.0546 0.2112 0.0572 0.0 0.0 2.08 0.0 2.2 1; %a2
+1 3 100 138 60 0.0 0.0 0.0546 0.2112 0.0572 0.0 0.0 2.08 0.0 2.2 1; %a3
+1 11 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-1
+12 1 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-2
+];
+
+SW.con = [ ...
+2 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+PV.con = [ ...
+ 11 100 138 0.5 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 12 100 138 0.25 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 3 100 138 1.0 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+PQ.con = [ ...
+  2   100  138  1.00  0.10  1.05  0.95  1  1;
+  3   100  138  2.00  0.10  1.05  0.95  1  1;
+ ];
+
+Demand.con = [ ...
+   2  100  1.00  0.242  1.00 1.00  0  0  18  0  0  0  0  0  0  0  0  1;
+   3  100  1.00  0.22   2.00 2.00  0  0  25  0  0  0  0  0  0  0  0  1;
+ ];
+
+Supply.con = [ ...
+ 11 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+ 12 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+ 3 100 0.1 2.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g3
+ 2 100 0.1 3.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g4
+];
+"""
+
+    def setUp(self):
+        self.psat = PsatData()
+        self.psat.read(StringIO(self.text))
+        self.arrays = PsatArrays(self.psat)
+
+    def text_of(self, psat):
+        stream = StringIO()
+        psat.write(stream)
+        return stream.getvalue()
+
+    def assertSame(self, arrays, psat):
+        self.assertEqual(self.text_of(arrays.to_psat()), self.text_of(psat))
+        for x, y in zip(arrays.get_stats(), psat.get_stats()):
+            self.assertAlmostEqual(x, y)
+
+    def check(self, buses, lines, generators, demand=None):
+        psat = self.psat.overlay()
+        arrays = self.arrays.overlay()
+        for case in [psat, arrays]:
+            case.apply_removals(buses, lines, generators)
+            if demand:
+                case.set_all_demand(demand)
+        self.assertSame(arrays, psat)
+        self.assertEqual(arrays.islanding(), psat.islanding())
+        batch = arrays.overlay()
+        self.assertEqual(fix_mismatches([batch]), [True])
+        psat.fix_mismatch()
+        arrays.fix_mismatch()
+        self.assertEqual(self.text_of(batch), self.text_of(arrays))
+        for x, y in zip(arrays.live("generators")["p"],
+                        [gen.p for _, gen in sorted(psat.generators.items())]):
+            self.assertAlmostEqual(x, y)
+
+    def test_write(self):
+        self.assertEqual(self.text_of(self.arrays), self.text_of(self.psat))
+        self.assertSame(self.arrays, self.psat)
+
+    def test_read(self):
+        arrays = PsatArrays()
+        arrays.read(StringIO(self.text))
+        self.assertEqual(self.text_of(arrays), self.text_of(self.psat))
+        self.assertSame(arrays, self.psat)
+
+    def test_removals(self):
+        self.check([], [], [])
+        self.check([1], [], [])
+        self.check([], ["a2", "c1-2"], ["g1"])
+        self.check([1], ["a1"], ["g2", "g3"], 0.5)
+        self.check([3], [], ["g1"], 1.1)
+        self.check([], ["a2", "a3"], [])
+        self.check([], ["c1-1"], [])
+
+    def test_long_cids(self):
+        cid = "a" + "x" * 40
+        text = self.text_of(self.psat).replace("%a1\n", "%" + cid + "\n")
+        arrays = PsatArrays()
+        arrays.read(StringIO(text))
+        psat = PsatData()
+        psat.read(StringIO(text))
+        self.assertTrue(cid in arrays.lines["cid"])
+        self.assertSame(arrays, psat)
+        self.assertSame(PsatArrays(psat), psat)
+        self.assertEqual(self.text_of(arrays), self.text_of(psat))
+
+    def test_unknown(self):
+        for lines, generators in ((["a9"], []), ([], ["g9"])):
+            self.assertRaises(KeyError, self.arrays.overlay().apply_removals,
+                              [1], lines, generators)
+            self.assertRaises(KeyError, self.psat.overlay().apply_removals,
+                              [1], lines, generators)
+
+    def test_shared(self):
+        arrays = self.arrays.overlay()
+        arrays.apply_removals([1], [], [])
+        arrays.set_all_demand(0.5)
+        self.assertTrue(arrays.lines is self.arrays.lines)
+        self.assertFalse(arrays.loads is self.arrays.loads)
+        self.assertSame(self.arrays, self.psat)
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+#==============================================================================
+#
+#==============================================================================
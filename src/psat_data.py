@@ -28,8 +28,12 @@ psat_data.py - PsatData - psat_file - psat
 #==============================================================================
 
 from misc import struct, read_struct, as_csv, duplicates_exist, EnsureEqual, \
-    Ensure, EnsureNotEqual, EnsureIn, Error
+    Ensure, EnsureNotEqual, EnsureIn, Error, OverlayDict, writable, DisjointSet
 import re
+import random
+import time
+import cPickle
+import numpy
 import unittest
 from StringIO import StringIO
 from modifiedtestcase import ModifiedTestCase
@@ -39,6 +43,20 @@ from modifiedtestcase import ModifiedTestCase
 #==============================================================================
 
 
+def row_text(value):
+    """the line of a Matlab file for `value`. It is cached on the struct
+       (until it changes) as most rows are the same in every scenario."""
+    text = value.__dict__.get("row_text")
+    if text is None:
+        if "cid" == value.entries[-1]:
+            tmp = as_csv([value.__dict__[x] for x in value.entries[:-1]], " ")
+            text = "  " + tmp + "; %" + value.cid + "\n"
+        else:
+            text = "  " + str(value) + ";\n"
+        value.__dict__["row_text"] = text
+    return text
+
+
 def write_section(stream, items, title):
     """write one section of a Matlab file"""
 
@@ -46,12 +64,8 @@ def write_section(stream, items, title):
         return
 
     stream.write(title + ".con = [ ... \n")
-    for _, value in sorted(items.items()):
-        if "cid" == value.entries[-1]:
-            tmp = as_csv([value.__dict__[x] for x in value.entries[:-1]], " ")
-            stream.write("  " + tmp + "; %" + value.cid + "\n")
-        else:
-            stream.write("  " + str(value) + ";\n")
+    for key in sorted(items):
+        stream.write(row_text(items[key]))
     stream.write("];\n\n")
 
 
@@ -87,6 +101,103 @@ def read_section(stream, classtype):
 
     return items
 
+section_pattern = re.compile(r"^[ \t]*(\w+)\.con[^\n]*\n(.*?)^ *\] *; *$", 
+                             re.M | re.S)
+
+
+def read_columns(stream):
+    """func read_columns :: Istream -> [(Str, Array(Real), [Str] or None)]
+       ----
+       read every section of a Matlab file in one pass. For each section
+       its title (e.g. 'Bus'), all its numbers as a (rows x columns) 
+       array and the component IDs (if the rows end in %XX). Anything 
+       outside a section must be blank or a comment.
+    """
+
+    text = stream.read()
+    sections = []
+    end = 0
+    for match in section_pattern.finditer(text):
+        outside = text[end:match.start()]
+        end = match.end()
+        for line in outside.splitlines():
+            line = line.strip()
+            if len(line) != 0 and not line.startswith("%"):
+                raise Error("expected matlab section, got '" + line + "'")
+
+        rows = [line.strip() for line in match.group(2).lower().splitlines()]
+        rows = [line for line in rows if len(line) != 0 and not line.startswith("%")]
+        cids = None
+        if any("%" in line for line in rows):
+            Ensure(all("%" in line for line in rows), 
+                   "some rows of %s have no ID" % match.group(1))
+            rows, cids = zip(*[line.split("%", 1) for line in rows])
+            cids = [cid.strip() for cid in cids]
+
+        rows = [line.replace(";", " ") for line in rows]
+        widths = set(len(line.split()) for line in rows)
+        Ensure(len(widths) <= 1, "incomplete info in " + match.group(1))
+        values = numpy.fromstring(" ".join(rows), sep=" ")
+        if len(rows):
+            Ensure(len(values) == len(rows) * widths.pop(), 
+                   "bad number in " + match.group(1))
+        sections.append((match.group(1), 
+                         values.reshape(len(rows), -1) if len(rows) else values,
+                         cids))
+
+    for line in text[end:].splitlines():
+        line = line.strip()
+        if len(line) != 0 and not line.startswith("%"):
+            raise Error("expected matlab section, got '" + line + "'")
+    return sections
+
+
+def make_structs(classtype, values, cids=None):
+    """the structs of `classtype` for each row of `values` (and cid). The
+       same as read_struct but without checking each one."""
+
+    convert = {"int": int, "real": float, "str": str}
+    numbers = classtype.entries[:-1] if cids is not None else classtype.entries
+    converters = [convert[kind] for kind in classtype.types[:len(numbers)]]
+    EnsureEqual(values.shape[1] if len(values) else len(numbers), len(numbers), 
+                "incomplete info for " + classtype.__name__)
+    typemap = dict(zip(classtype.entries, classtype.types))
+
+    items = []
+    for n, row in enumerate(values.tolist()):
+        item = object.__new__(classtype)
+        fields = item.__dict__
+        for name, conv, value in zip(numbers, converters, row):
+            fields[name] = conv(value)
+        if cids is not None:
+            fields["cid"] = cids[n]
+        fields["typemap"] = typemap
+        items.append(item)
+    return items
+
+
+def benchmark_read(filename, repeat=10):
+    """print how long `repeat` reads of `filename` take using
+       PsatData.read & PsatData.read_fast and check they match"""
+
+    with open(filename) as stream:
+        text = stream.read()
+
+    results = {}
+    for method in ["read", "read_fast"]:
+        timer_start = time.time()
+        for _ in range(repeat):
+            psat = PsatData()
+            getattr(psat, method)(StringIO(text))
+        results[method] = psat
+        print "%s\t%f seconds per read" % (method, 
+                                           (time.time() - timer_start) / repeat)
+
+    slow, fast = StringIO(), StringIO()
+    results["read"].write(slow)
+    results["read_fast"].write(fast)
+    EnsureEqual(slow.getvalue(), fast.getvalue(), "reads differ")
+
 #==============================================================================
 #
 #==============================================================================
@@ -138,6 +249,27 @@ class PsatData(object):
         self.supply = {}
         self.mismatch = 0.0
 
+        # indexes kept up to date by `remove_*` (the other sections are
+        # already keyed by bus_no).
+        self.lines_by_bus = {}
+        self.supply_by_bus = {}
+        self.bid_limits = {}
+
+    sections = ("busses lines slack generators loads shunts demand supply " +
+                "lines_by_bus supply_by_bus bid_limits").split()
+
+    def overlay(self):
+        """a copy of this PsatData that shares its components until they
+           change (see misc.OverlayDict). So it is quick to make and only
+           costs as much as is removed or changed from this one, which 
+           must not itself change while the copy is in use.
+        """
+        new = PsatData()
+        for section in self.sections:
+            setattr(new, section, OverlayDict(getattr(self, section)))
+        new.mismatch = self.mismatch
+        return new
+
     def read(self, stream):
      
         def title_matches(line, title):
@@ -179,8 +311,61 @@ class PsatData(object):
             else:
                 raise Error("expected matlab section, got '" + line + "'")
 
+        self.index()
+        self.invariant()
+
+    def read_fast(self, stream):
+        """the same as `read` but each section is parsed in one go by 
+           read_columns rather than line by line"""
+
+        sections = {"Bus": (self.busses, self.Bus),
+                    "Line": (self.lines, self.Line),
+                    "SW": (self.slack, self.Slack),
+                    "PV": (self.generators, self.Generator),
+                    "PQ": (self.loads, self.Load),
+                    "Shunt": (self.shunts, self.Shunt),
+                    "Supply": (self.supply, self.Supply),
+                    "Demand": (self.demand, self.Demand)}
+
+        for title, values, cids in read_columns(stream):
+            EnsureIn(title, sections, "unknown matlab section")
+            storage, classtype = sections[title]
+            EnsureEqual(len(storage), 0)
+            EnsureEqual(cids is not None, "cid" == classtype.entries[-1], 
+                        "component IDs of " + title)
+            for item in make_structs(classtype, values, cids):
+                if cids is not None:
+                    storage[item.cid] = item
+                else:
+                    storage[item.bus_no] = item
+
+        self.index()
         self.invariant()
 
+    def index(self):
+        """build the lines and supply at each bus and their bid limits"""
+        self.lines_by_bus = {}
+        for line in self.lines.values():
+            self.lines_by_bus.setdefault(line.fbus, set()).add(line.cid)
+            self.lines_by_bus.setdefault(line.tbus, set()).add(line.cid)
+
+        self.supply_by_bus = {}
+        for supply in self.supply.values():
+            self.supply_by_bus.setdefault(supply.bus_no, set()).add(supply.cid)
+
+        self.bid_limits = {}
+        for bus_no in self.supply_by_bus:
+            self.update_bid_limits(bus_no)
+
+    def update_bid_limits(self, bus_no):
+        supplies = [self.supply[cid] for cid in self.supply_by_bus[bus_no]]
+        self.bid_limits[bus_no] = (sum(s.p_bid_min for s in supplies),
+                                   sum(s.p_bid_max for s in supplies))
+
+    def bid_limit(self, bus_no):
+        """the sum of the min and max bids of the supply at `bus_no`"""
+        return self.bid_limits.get(bus_no, (0.0, 0.0))
+
     def invariant(self):
         passed = self.in_limits()
 
@@ -192,73 +377,121 @@ class PsatData(object):
         return passed
     
     def write(self, stream):
-        write_section(stream, self.busses, "Bus")
-        write_section(stream, self.lines, "Line")
-        write_section(stream, self.slack, "SW")
-        write_section(stream, self.generators, "PV")
-        write_section(stream, self.loads, "PQ")
-        write_section(stream, self.shunts, "Shunt")
-        write_section(stream, self.demand, "Demand")
-        write_section(stream, self.supply, "Supply")
+        # built in memory so the file gets a single write
+        buf = StringIO()
+        write_section(buf, self.busses, "Bus")
+        write_section(buf, self.lines, "Line")
+        write_section(buf, self.slack, "SW")
+        write_section(buf, self.generators, "PV")
+        write_section(buf, self.loads, "PQ")
+        write_section(buf, self.shunts, "Shunt")
+        write_section(buf, self.demand, "Demand")
+        write_section(buf, self.supply, "Supply")
+        stream.write(buf.getvalue())
 
     def remove_bus(self, bus_no):
-
-        # TODO: really should be an 'assert' not an 'if' but make testing easier
-        if len(self.slack) == 1:
-            slack = self.slack.values()[0]
-            EnsureNotEqual(slack.bus_no, bus_no)
-        else:
-            print "Expected one slack got %d" % len(self.slack)
- 
-
-        EnsureEqual(self.busses[bus_no].bus_no, bus_no)
-        del self.busses[bus_no]
+        self.apply_removals(buses=[bus_no])
+
+    def apply_removals(self, buses=(), lines=(), generators=()):
+        """remove all the `buses`, `lines` and `generators` (by supply 
+           cid) at once. The same as calling remove_* on each but every 
+           component is visited once and anything removed along with a
+           removed bus (e.g. its lines) is skipped. Raises KeyError for 
+           lines or generators the psat doesn't have.
+        """
 
         # as we now have virtal busses that connect to generators
         # we need to find and delete any of those hat connect to
-        # this bus. 
-        # We can find them by using the cid of the lines
-        # find all lines with who's cid starts with "C" that 
-        # connect to this bus
-
-        for line in self.lines.values():
-            if line.fbus == bus_no:
-                self.remove_line(line.cid)
-                if line.cid.startswith("c"):
-                    self.remove_bus(line.tbus)
-            elif line.tbus == bus_no:
-                self.remove_line(line.cid)
-                if line.cid.startswith("c"):
-                    self.remove_bus(line.fbus)
+        # a removed bus. They are the other end of the lines whose
+        # cid starts with "c", found in one pass over the busses.
+
+        dead_busses = set()
+        todo = list(buses)
+        while todo:
+            bus_no = todo.pop()
+            if bus_no in dead_busses:
+                continue
+            EnsureEqual(self.busses[bus_no].bus_no, bus_no)
+            dead_busses.add(bus_no)
+            for cid in self.lines_by_bus.get(bus_no, ()):
+                if cid.startswith("c"):
+                    line = self.lines[cid]
+                    if line.fbus == bus_no:
+                        todo.append(line.tbus)
+                    else:
+                        todo.append(line.fbus)
+
+        if dead_busses:
+            # TODO: really should be an 'assert' not an 'if' but make testing easier
+            if len(self.slack) == 1:
+                slack = self.slack.values()[0]
+                Ensure(slack.bus_no not in dead_busses, 
+                       "can't remove the slack bus %d" % slack.bus_no)
+            else:
+                print "Expected one slack got %d" % len(self.slack)
+
+        # a line the psat doesn't have is a mistake (KeyError) even if
+        # its busses are removed
+        dead_lines = set()
+        for cid in lines:
+            if cid not in self.lines:
+                raise KeyError(cid)
+            dead_lines.add(cid)
+        for bus_no in dead_busses:
+            dead_lines.update(self.lines_by_bus.get(bus_no, ()))
+
+        for cid in dead_lines:
+            line = self.lines[cid]
+            for bus_no in (line.fbus, line.tbus):
+                if bus_no not in dead_busses and bus_no in self.lines_by_bus:
+                    writable(self.lines_by_bus, bus_no).discard(cid)
+            del self.lines[cid]
 
         # kill all connecting items
-        for idx, shunt in self.shunts.items():
-            if shunt.bus_no == bus_no:
-                del self.shunts[idx]
+        mismatch = 0.0
+        dead_supply = set()
+        for bus_no in dead_busses:
+            del self.busses[bus_no]
+            self.lines_by_bus.pop(bus_no, None)
+
+            if bus_no in self.shunts:
+                del self.shunts[bus_no]
 
-        for idx, item in self.demand.items():
-            if item.bus_no == bus_no:
-                del self.demand[idx]
+            if bus_no in self.demand:
+                del self.demand[bus_no]
 
-        for idx, item in self.supply.items():
-            if item.bus_no == bus_no:
-                del self.supply[idx]
+            for cid in self.supply_by_bus.pop(bus_no, ()):
+                del self.supply[cid]
+                dead_supply.add(cid)
+            self.bid_limits.pop(bus_no, None)
 
-        for idx, gen in self.generators.items():
-            if gen.bus_no == bus_no:
-                self.mismatch -= gen.p
-                del self.generators[idx]
+            if bus_no in self.generators:
+                mismatch -= self.generators[bus_no].p
+                del self.generators[bus_no]
 
-        for idx, load in self.loads.items():
-            if load.bus_no == bus_no:
-                self.mismatch += load.p
-                del self.loads[idx]
+            if bus_no in self.loads:
+                mismatch += self.loads[bus_no].p
+                del self.loads[bus_no]
+        self.mismatch += mismatch
 
+        for supply_id in generators:
+            if supply_id not in dead_supply:
+                self.remove_generator(supply_id)
 
     def remove_line(self, line_id):
+        line = self.lines[line_id]
+        for bus_no in (line.fbus, line.tbus):
+            if bus_no in self.lines_by_bus:
+                writable(self.lines_by_bus, bus_no).discard(line_id)
         del self.lines[line_id]
         # TODO:: deal with islanding
 
+    def remove_supply(self, supply_id):
+        bus_no = self.supply[supply_id].bus_no
+        del self.supply[supply_id]
+        writable(self.supply_by_bus, bus_no).discard(supply_id)
+        self.update_bid_limits(bus_no)
+
     def remove_generator(self, supply_id):
         """kill the specified supply and corresponding generator
            with the requiement that there is only one generator
@@ -276,13 +509,14 @@ class PsatData(object):
             Ensure(bus_no in self.generators, "missing generator info (%s)" % bus_no)
             self.mismatch -= self.generators[bus_no].p 
             del self.generators[bus_no]
-            del self.supply[supply_id]
+            self.remove_supply(supply_id)
             return 
         
         EnsureEqual(len(self.slack), 1)
         slack = self.slack.values()[0]
 
         if slack.bus_no == bus_no:
+            slack = writable(self.slack, self.slack.keys()[0])
             
             # todo: lets just hope that's accurate, it's probably not.
             self.mismatch -= slack.p_guess 
@@ -292,7 +526,7 @@ class PsatData(object):
             # new value from the chosen bus. 
             
             # we do want to remove this. 
-            del self.supply[supply_id]
+            self.remove_supply(supply_id)
 
             allowed_slacks = [37, 38]
             gen = None 
@@ -322,7 +556,7 @@ class PsatData(object):
             EnsureIn(bus_no, self.generators, "missing generator info")
             self.mismatch -= self.generators[bus_no].p 
             del self.generators[bus_no]
-            del self.supply[supply_id]
+            self.remove_supply(supply_id)
 
     def set_all_demand(self, value):
         # Note:: should I change P, Q or both.
@@ -332,33 +566,22 @@ class PsatData(object):
         # with value above 1.08 currently 
         Ensure(0 < value <= 4, "just a vague sanity check")
 
-        for load in self.loads.values():
+        for key in self.loads.keys():
+            load = writable(self.loads, key)
+            demand = writable(self.demand, load.bus_no)
             newval = load.p * value
             self.mismatch += load.p - newval
             load.p = newval
-            self.demand[load.bus_no].p_bid_max = newval
-            self.demand[load.bus_no].p_bid_min = newval
+            demand.p_bid_max = newval
+            demand.p_bid_min = newval
             
     def get_stats(self):
         
         scheduleable_generators = self.generators.values()
-        min_limit = []
-        max_limit = []
-        for gen in scheduleable_generators:
-            min_limit.append(sum(supply.p_bid_min for supply in 
-                              self.supply.values() 
-                              if supply.bus_no == gen.bus_no))
-            max_limit.append(sum(supply.p_bid_max for supply in 
-                              self.supply.values() 
-                              if supply.bus_no == gen.bus_no))
-
-        for slack in self.slack.values():
-            min_limit.append(sum(supply.p_bid_min for supply in 
-                              self.supply.values() 
-                              if supply.bus_no == slack.bus_no))
-            max_limit.append(sum(supply.p_bid_max for supply in 
-                              self.supply.values() 
-                              if supply.bus_no == slack.bus_no))
+        limits = ([self.bid_limit(gen.bus_no) for gen in scheduleable_generators] + 
+                  [self.bid_limit(slack.bus_no) for slack in self.slack.values()])
+        min_limit = [low for low, _ in limits]
+        max_limit = [high for _, high in limits]
                 
         gpowers = [gen.p for gen in scheduleable_generators] + [slack.p_guess for slack in self.slack.values()]
         lpowers = [load.p for load in self.loads.values()]
@@ -386,24 +609,10 @@ class PsatData(object):
         
             gpowers = [gen.p for gen in scheduleable_generators] + [slack.p_guess for slack in self.slack.values()]
             
-            min_limit = []
-            max_limit = []
-            for gen in scheduleable_generators:
-                min_limit.append(sum(supply.p_bid_min for supply in 
-                                  self.supply.values() 
-                                  if supply.bus_no == gen.bus_no))
-                max_limit.append(sum(supply.p_bid_max for supply in 
-                                  self.supply.values() 
-                                  if supply.bus_no == gen.bus_no))
-                
-
-            for slack in self.slack.values():
-                min_limit.append(sum(supply.p_bid_min for supply in 
-                                  self.supply.values() 
-                                  if supply.bus_no == slack.bus_no))
-                max_limit.append(sum(supply.p_bid_max for supply in 
-                                  self.supply.values() 
-                                  if supply.bus_no == slack.bus_no))
+            limits = ([self.bid_limit(gen.bus_no) for gen in scheduleable_generators] + 
+                      [self.bid_limit(slack.bus_no) for slack in self.slack.values()])
+            min_limit = [low for low, _ in limits]
+            max_limit = [high for _, high in limits]
     
             #print "-----"
             #print "t %f => %f < %f < %f" % (self.mismatch, sum(min_limit), sum(powers), sum(max_limit))
@@ -428,9 +637,35 @@ class PsatData(object):
             res = fix_mismatch(-self.mismatch, gpowers, min_limit, max_limit)
     
             for newp, generator in zip(res, scheduleable_generators):
-                generator.p = newp
+                writable(self.generators, generator.bus_no).p = newp
 
         Ensure(self.in_limits(), "fixing mismatch should leave it in limit")
+
+    def units(self):
+        """the generators then the slack as ("generator" or "slack", 
+           bus_no) so a slack & generator on one bus are separate units
+           as in fix_mismatch"""
+        return ([("generator", gen.bus_no) for gen in self.generators.values()] + 
+                [("slack", slack.bus_no) for slack in self.slack.values()])
+
+    def unit_dispatch(self, units):
+        """the power & bid limits of each of `units` (see `units`) as 
+           fix_mismatch uses them and which are there."""
+        powers = dict((("slack", slack.bus_no), slack.p_guess) 
+                      for slack in self.slack.values())
+        powers.update((("generator", gen.bus_no), gen.p) 
+                      for gen in self.generators.values())
+        power = numpy.array([powers.get(unit, 0.0) for unit in units], float)
+        limits = numpy.array([self.bid_limit(bus_no) for _, bus_no in units], float)
+        alive = numpy.array([unit in powers for unit in units], bool)
+        return power, limits[:, 0], limits[:, 1], alive
+
+    def set_generator_power(self, units, power):
+        """set the power of the generators of `units` (see `units`); as in
+           fix_mismatch the slack is left to take up the difference."""
+        for (kind, bus_no), newp in zip(units, power):
+            if kind == "generator" and bus_no in self.generators:
+                writable(self.generators, bus_no).p = float(newp)
     
     def in_limits(self):
         """
@@ -443,10 +678,7 @@ class PsatData(object):
         inlimit = True
         for generator in self.generators.values():
             bus_no = generator.bus_no
-            supplies = [s for s in self.supply.values() if s.bus_no == bus_no]
-            # assert len(supplies) > 1 # often true but not needed.
-            max_bid = sum(s.p_bid_max for s in supplies)
-            min_bid = sum(s.p_bid_min for s in supplies)
+            min_bid, max_bid = self.bid_limit(bus_no)
 
             if not (generator.p == 0 or min_bid <= generator.p <= max_bid):
                 print "generator", bus_no , "power limit:",
@@ -466,11 +698,77 @@ class PsatData(object):
 
         return inlimit
 
+    def islanding(self):
+        """the islands cut off from the slack (see `islanding`)"""
+        return islanding(self.busses.keys(),
+                         [(line.fbus, line.tbus) for line in self.lines.values()],
+                         [slack.bus_no for slack in self.slack.values()],
+                         [bus_no for bus_no, cids in self.supply_by_bus.items() if cids],
+                         list(self.loads) + list(self.demand))
+
 #==============================================================================
 #
 #==============================================================================
 
 
+class Islanded(Error):
+    """the scenario splits the network; `islands` is from `islanding`"""
+
+    def __init__(self, islands):
+        Error.__init__(self, "islanded: " + ", ".join(
+                "%s %s" % (kind, busses) for kind, busses in islands))
+        self.islands = islands
+
+
+island_kinds = ["isolated bus", "isolated load", "isolated generation", 
+                "split system"]
+
+
+def islanding(bus_nos, branches, slack_busses, supply_busses, load_busses):
+    """
+    func islanding :: [Int], [(Int, Int)], [Int], [Int], [Int] -> [(Str, [Int])]
+
+    Split the busses into connected islands (union-find over the
+    `branches`) and return every island other than the one with the
+    slack (or the biggest, if there is none) as (kind, sorted busses).
+    The kind (see `island_kinds`) is by what the island has on it:
+    nothing, only load, only generation or both. Empty if the network
+    is whole.
+    """
+
+    sets = DisjointSet(bus_nos)
+    for fbus, tbus in branches:
+        sets.union(fbus, tbus)
+    islands = sets.groups()
+    if len(islands) < 2:
+        return []
+
+    slack_roots = set(sets.find(bus_no) for bus_no in slack_busses 
+                      if bus_no in sets.parent)
+    if slack_roots:
+        islands = [x for x in islands if sets.find(x[0]) not in slack_roots]
+    else:
+        islands.remove(max(islands, key=len))
+
+    supply_busses, load_busses = set(supply_busses), set(load_busses)
+    result = []
+    for island in islands:
+        has_load = any(bus_no in load_busses for bus_no in island)
+        has_supply = any(bus_no in supply_busses for bus_no in island)
+        result.append((island_kinds[has_load + 2 * has_supply], 
+                       sorted(island)))
+    return sorted(result, key=lambda x: x[1])
+
+
+class InfeasibleMismatch(Error):
+    """the generators can't take up the mismatch within their limits"""
+    pass
+
+
+# the most each generator may be scaled by to fix a mismatch
+max_multiplier = 5
+
+
 def fix_mismatch(mismatch, power, min_limit, max_limit):
     """
     func fix_mismatch :: Real, [Real], [Real], [Real] -> [Real]
@@ -479,6 +777,82 @@ def fix_mismatch(mismatch, power, min_limit, max_limit):
     Do this based upon current power of each generator
     taking into account its limits.
     Returns a list of new generator powers
+
+    Gives the same result as `fix_mismatch_iterative` in O(n log n): a 
+    generator hits its limit once the multiplier passes limit / power,
+    and the multiplier only moves further that way as generators are
+    limited, so they are limited in order of that ratio until the next
+    one doesn't need to be. Raises InfeasibleMismatch if it can't be done.
+    """
+
+    EnsureEqual(len(power), len(min_limit))
+    EnsureEqual(len(power), len(max_limit))
+
+    if mismatch == 0:
+        return power
+
+    if any(p < 0 for p in power):
+        # the multiplier isn't monotonic so the ordering doesn't hold
+        return fix_mismatch_iterative(mismatch, power, min_limit, max_limit)
+
+    if not sum(min_limit) < sum(power) + mismatch < sum(max_limit):
+        raise InfeasibleMismatch(
+            "mismatch of %f is outside limits (%f < %f < %f)" % (
+                mismatch, sum(min_limit), sum(power) + mismatch, sum(max_limit)))
+
+    if mismatch > 0:
+        limit, sign = max_limit, 1
+    else:
+        limit, sign = min_limit, -1
+
+    def over(n, multiplier):
+        return sign * (power[n] * multiplier - limit[n]) > 0
+
+    result = [float(p) for p in power]
+    total_gen = 0.0
+    scalable = []
+    for n, p in enumerate(power):
+        if p == 0:
+            # can't be scaled, only limited if it is already over
+            if over(n, 1.0):
+                result[n] = limit[n]
+                mismatch -= limit[n]
+        else:
+            scalable.append(n)
+            total_gen += p
+    if not scalable:
+        raise InfeasibleMismatch("no generating generators to take up the mismatch")
+    scalable.sort(key=lambda n: sign * limit[n] / float(power[n]))
+
+    limited = 0
+    for n in scalable:
+        if not over(n, 1.0 + (mismatch / total_gen)):
+            break
+        result[n] = limit[n]
+        mismatch -= limit[n] - power[n]
+        total_gen -= power[n]
+        limited += 1
+        if limited == len(scalable):
+            raise InfeasibleMismatch(
+                "every generator is at its limit with %f left" % mismatch)
+
+    multiplier = 1.0 + (mismatch / total_gen)
+    if not 0 <= multiplier <= max_multiplier:
+        raise InfeasibleMismatch(
+            "generators would be scaled by %f (not 0 to %d)" % (
+                multiplier, max_multiplier))
+
+    for n in scalable[limited:]:
+        result[n] = power[n] * multiplier
+    return result
+
+
+def fix_mismatch_iterative(mismatch, power, min_limit, max_limit):
+    """
+    func fix_mismatch_iterative :: Real, [Real], [Real], [Real] -> [Real]
+    
+    The original O(n^2) version of `fix_mismatch`, which finds the
+    generators that hit their limit one scan at a time.
     """
 
     EnsureEqual(len(power), len(min_limit))
@@ -586,6 +960,161 @@ def fix_mismatch(mismatch, power, min_limit, max_limit):
 #==============================================================================
 
 
+def fix_mismatch_batch(mismatch, power, min_limit, max_limit, alive):
+    """
+    func fix_mismatch_batch :: Array(Real), Array(Real), Array(Real), 
+                               Array(Real), Array(Bool) -> Array(Real), Array(Bool)
+
+    `fix_mismatch` for many scenarios at once. `mismatch` has one value
+    per scenario, `alive` is a (scenario x generator) mask of those left
+    and `power`, `min_limit` & `max_limit` are per generator or per 
+    scenario and generator. Returns the new power of each generator in
+    each scenario (0 where not alive) and which scenarios are feasible;
+    the power of the infeasible ones is left as it was.
+    """
+
+    mismatch = numpy.asarray(mismatch, float)
+    alive = numpy.asarray(alive, bool)
+    shape = alive.shape
+    EnsureEqual(mismatch.shape, shape[:1])
+    power = numpy.broadcast_to(numpy.asarray(power, float), shape) * alive
+    min_limit = numpy.broadcast_to(numpy.asarray(min_limit, float), shape)
+    max_limit = numpy.broadcast_to(numpy.asarray(max_limit, float), shape)
+
+    result = power.copy()
+    feasible = numpy.ones(shape[0], bool)
+
+    total = power.sum(1) + mismatch
+    feasible[mismatch != 0] = (((min_limit * alive).sum(1) < total) & 
+                               (total < (max_limit * alive).sum(1)))[mismatch != 0]
+
+    # as for fix_mismatch, negative powers have to be done one at a time
+    slow = (power < 0).any(1) & feasible & (mismatch != 0)
+    for row in slow.nonzero()[0]:
+        cols = alive[row].nonzero()[0]
+        try:
+            result[row, cols] = fix_mismatch_iterative(
+                mismatch[row], list(power[row, cols]), 
+                list(min_limit[row, cols]), list(max_limit[row, cols]))
+        except Error:
+            feasible[row] = False
+
+    for sign in [1, -1]:
+        rows = (sign * mismatch > 0) & feasible & ~slow
+        if not rows.any():
+            continue
+        power_rows = power[rows]
+        alive_rows = alive[rows]
+        limit_rows = (max_limit if sign == 1 else min_limit)[rows]
+        left = mismatch[rows]
+
+        # units at 0 only change if they start over their limit
+        forced = alive_rows & (power_rows == 0) & (sign * -limit_rows > 0)
+        left = left - (limit_rows * forced).sum(1)
+
+        # limit the scalable units in order of limit / power while 
+        # the multiplier before each one would take it over
+        scalable = alive_rows & (power_rows > 0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratio = numpy.where(scalable, sign * limit_rows / power_rows,
+                                numpy.inf)
+        order = numpy.argsort(ratio, 1, kind="mergesort")
+        sorted_power = numpy.take_along_axis(power_rows * scalable, order, 1)
+        sorted_limit = numpy.take_along_axis(limit_rows, order, 1)
+        sorted_scalable = numpy.take_along_axis(scalable, order, 1)
+        gain = (sorted_limit - sorted_power) * sorted_scalable
+        left_before = left[:, None] - (numpy.cumsum(gain, 1) - gain)
+        total_before = (sorted_power.sum(1)[:, None] - 
+                        (numpy.cumsum(sorted_power, 1) - sorted_power))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            scaled = sorted_power * (1.0 + left_before / total_before)
+            over = sorted_scalable & (sign * (scaled - sorted_limit) > 0)
+        limited = (numpy.logical_and.accumulate(over | ~sorted_scalable, 1) & 
+                   sorted_scalable)
+
+        total_gen = sorted_power.sum(1) - (sorted_power * limited).sum(1)
+        left = left - (gain * limited).sum(1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            multiplier = 1.0 + left / total_gen
+            ok = ((limited.sum(1) < sorted_scalable.sum(1)) & 
+                  (total_gen > 0) & 
+                  (0 <= multiplier) & (multiplier <= max_multiplier))
+            new = numpy.where(limited, sorted_limit, 
+                              sorted_power * multiplier[:, None])
+        numpy.put_along_axis(new, order, new.copy(), 1)
+        new = numpy.where(scalable, new, numpy.where(forced, limit_rows, 0.0))
+        row_nos = rows.nonzero()[0]
+        result[row_nos[ok]] = new[ok]
+        feasible[row_nos[~ok]] = False
+
+    return result, feasible
+
+
+def fix_mismatches(psats):
+    """
+    func fix_mismatches :: [PsatData] -> [Bool]
+
+    PsatData.fix_mismatch for all of `psats` (e.g. scenarios made from
+    one base case) in one vectorised pass. Returns which were feasible;
+    only those are changed.
+    """
+
+    if not psats:
+        return []
+    units = sorted(set().union(*[psat.units() for psat in psats]))
+
+    dispatch = [psat.unit_dispatch(units) for psat in psats]
+    power, min_limit, max_limit, alive = [numpy.array(x) for x in zip(*dispatch)]
+    mismatch = numpy.array([-psat.mismatch for psat in psats], float)
+    result, feasible = fix_mismatch_batch(mismatch, power, min_limit, 
+                                          max_limit, alive)
+
+    for psat, row, ok, change in zip(psats, result, feasible, mismatch != 0):
+        if ok and change:
+            psat.set_generator_power(units, row)
+    return list(feasible)
+
+
+def random_dispatch(count, rand=random):
+    """a random (mismatch, power, min_limit, max_limit) of `count`
+       generators for testing fix_mismatch"""
+    power = [rand.choice([0.0, rand.uniform(0, 5)]) for _ in range(count)]
+    min_limit = [rand.uniform(-1, 1) * p for p in power]
+    max_limit = [p + rand.uniform(0, 2) for p in power]
+    low, high = sum(min_limit) - sum(power), sum(max_limit) - sum(power)
+    return rand.uniform(low, high), power, min_limit, max_limit
+
+
+def benchmark_fix_mismatch(sizes=(10, 100, 1000, 5000), repeat=3):
+    """print how long fix_mismatch & fix_mismatch_iterative take on
+       random dispatches of each size and check they match"""
+
+    rand = random.Random(1)
+    for size in sizes:
+        cases = [random_dispatch(size, rand) for _ in range(repeat)]
+        results = {}
+        for func in [fix_mismatch_iterative, fix_mismatch]:
+            timer_start = time.time()
+            results[func] = []
+            for case in cases:
+                try:
+                    results[func].append(func(*case))
+                except Error:
+                    results[func].append(None)
+            print "%d generators\t%s\t%f seconds per call" % (
+                size, func.__name__, (time.time() - timer_start) / repeat)
+
+        for old, new in zip(results[fix_mismatch_iterative], results[fix_mismatch]):
+            EnsureEqual(old is None, new is None, "results differ")
+            if old is not None:
+                Ensure(max(abs(x - y) for x, y in zip(old, new)) < 1e-6, 
+                       "results differ")
+
+#==============================================================================
+#
+#==============================================================================
+
+
 class Test_fix_mismatch(ModifiedTestCase):
 
     def test_1(self):
@@ -654,6 +1183,82 @@ class Test_fix_mismatch(ModifiedTestCase):
         res = fix_mismatch(-3.0, p_list, min_list, max_list)
         self.assertAlmostEqualList(res, [0, 3])
 
+    def test_infeasible(self):
+        self.assertRaises(InfeasibleMismatch, fix_mismatch, 
+                          3.0, [1, 1], [0, 0], [2, 2])
+        self.assertRaises(InfeasibleMismatch, fix_mismatch, 
+                          1.0, [0, 0], [0, 0], [2, 2])
+        self.assertRaises(InfeasibleMismatch, fix_mismatch, 
+                          9.0, [1, 0], [0, 0], [20, 20])
+
+    def test_batch(self):
+        rand = random.Random(3)
+        for count in [1, 2, 5, 20]:
+            cases = [random_dispatch(count, rand) for _ in range(50)]
+            mismatch = [case[0] for case in cases]
+            power, min_limit, max_limit = [numpy.array([case[n] for case in cases])
+                                           for n in [1, 2, 3]]
+            alive = numpy.array([[rand.random() < 0.8 for _ in range(count)]
+                                 for _ in cases])
+            mismatch[0] = 0.0
+            result, feasible = fix_mismatch_batch(mismatch, power, min_limit,
+                                                  max_limit, alive)
+            self.assertTrue(feasible.any() and not feasible.all())
+            for n in range(len(cases)):
+                cols = alive[n].nonzero()[0]
+                args = [list(x[n, cols]) for x in [power, min_limit, max_limit]]
+                try:
+                    expected = fix_mismatch(mismatch[n], *args)
+                except InfeasibleMismatch:
+                    self.assertFalse(feasible[n])
+                else:
+                    self.assertTrue(feasible[n])
+                    self.assertAlmostEqualList(result[n, cols], expected)
+                    self.assertAlmostEqualList(result[n][~alive[n]], 
+                                               [0] * (count - len(cols)))
+
+    def test_shared_bus(self):
+        psat = PsatData()
+        psat.read(StringIO("""Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+];
+
+SW.con = [ ...
+1 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+PV.con = [ ...
+1 100 138 0.3 1.035 0.8 -0.5 1.05 0.95 1.0 1
+2 100 138 0.5 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+Supply.con = [ ...
+1 100 0.1 3.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+2 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""))
+        psat.mismatch = -0.6
+        self.assertEqual(len(psat.units()), 3)
+        single, batch = psat.overlay(), psat.overlay()
+        single.fix_mismatch()
+        self.assertEqual(fix_mismatches([batch]), [True])
+        for bus_no in [1, 2]:
+            self.assertAlmostEqual(batch.generators[bus_no].p, 
+                                   single.generators[bus_no].p)
+        self.assertNotAlmostEqual(batch.generators[1].p, 0.3)
+
+    def test_same_as_iterative(self):
+        rand = random.Random(2)
+        for count in [1, 2, 5, 20, 100] * 20:
+            case = random_dispatch(count, rand)
+            try:
+                expected = fix_mismatch_iterative(*case)
+            except Error:
+                self.assertRaises(InfeasibleMismatch, fix_mismatch, *case)
+            else:
+                self.assertAlmostEqualList(fix_mismatch(*case), expected)
+
 
 
 #==============================================================================
@@ -919,6 +1524,28 @@ PV.con = [ ...
             set([1]),
             set(self.pd.generators))
 
+    def test_apply_removals(self):
+        self.pd.apply_removals([2], ["a5", "a2"], ["g7", "g1"])
+        self.assertEqual(
+            set([1, 3, 4]),
+            set(self.pd.busses))
+        self.assertEqual(
+            set("a3".split()),
+            set(self.pd.lines))
+        self.assertEqual(
+            set("g2 g3 g4 g5".split()),
+            set(self.pd.supply))
+        self.assertEqual(
+            set([]),
+            set(self.pd.generators))
+
+    def test_apply_removals_unknown(self):
+        self.assertRaises(KeyError, self.pd.overlay().apply_removals, 
+                          [2], ["a9"], [])
+        self.assertRaises(KeyError, self.pd.overlay().apply_removals, 
+                          [2], [], ["g9"])
+
+
 
 #==============================================================================
 #
@@ -1016,5 +1643,232 @@ Demand.con = [ ...
 #==============================================================================
 
 
+class Test_overlay(ModifiedTestCase):
+
+    text = """Bus.con = [ ... 
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+3 138 1 0 2 1;
+];
+
+Line.con = [ ... 
+1 2 100 138 60 0.0 0.0 0.0026 0.0139 0.4611 0.0 0.0 1.93 0.0 2.0 1; %a1
+2 3 100 138 60 0.0 0.0 0.0546 0.2112 0.0572 0.0 0.0 2.08 0.0 2.2 1; %a2
+];
+
+PV.con = [ ... 
+ 1 100 138 2.0 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 2 100 138 1.0 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+PQ.con = [ ... 
+  2   100  138  1.00  0.10  1.05  0.95  1  1;
+  3   100  138  2.00  0.10  1.05  0.95  1  1;
+ ];
+
+Demand.con = [ ... 
+   2  100  1.00  0.242  1.00 1.00  0  0  18  0  0  0  0  0  0  0  0  1;
+   3  100  1.00  0.22   2.00 2.00  0  0  25  0  0  0  0  0  0  0  0  1;
+ ];
+
+Supply.con = [ ... 
+ 1 100 0.1 4.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+ 2 100 0.1 4.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""
+
+    def setUp(self):
+        self.pd = PsatData()
+        self.pd.read(StringIO(self.text))
+
+    def text_of(self, psat):
+        stream = StringIO()
+        psat.write(stream)
+        return stream.getvalue()
+
+    def change(self, psat):
+        psat.remove_bus(3)
+        psat.remove_generator("g2")
+        psat.set_all_demand(0.5)
+        psat.fix_mismatch()
+
+    def test_same_as_copy(self):
+        over = self.pd.overlay()
+        self.change(over)
+        other = PsatData()
+        other.read(StringIO(self.text))
+        self.change(other)
+        self.assertEqual(self.text_of(over), self.text_of(other))
+        self.assertEqual(over.mismatch, other.mismatch)
+        self.assertEqual(set(over.busses), set([1, 2]))
+        self.assertEqual(len(over.lines), 1)
+
+    def test_base_unchanged(self):
+        before = self.text_of(self.pd)
+        self.change(self.pd.overlay())
+        self.assertEqual(self.text_of(self.pd), before)
+        self.assertEqual(self.pd.mismatch, 0)
+
+    def test_row_text(self):
+        before = self.text_of(self.pd)
+        self.assertTrue("row_text" in self.pd.loads[2].__dict__)
+        over = self.pd.overlay()
+        over.set_all_demand(0.5)
+        self.assertTrue("row_text" not in over.loads[2].__dict__)
+        self.assertTrue("  2 100 138 0.5 0.1 1.05 0.95 1.0 1;\n" in 
+                        self.text_of(over))
+        self.assertEqual(self.text_of(self.pd), before)
+
+    def test_shared(self):
+        over = self.pd.overlay()
+        over.remove_line("a2")
+        self.assertTrue(over.lines["a1"] is self.pd.lines["a1"])
+        self.assertEqual(len(over.lines.changed), 0)
+
+
+class Test_read_fast(ModifiedTestCase):
+
+    def assertSameRead(self, text):
+        slow, fast = PsatData(), PsatData()
+        slow.read(StringIO(text))
+        fast.read_fast(StringIO(text))
+        for section in PsatData.sections:
+            slow_items, fast_items = getattr(slow, section), getattr(fast, section)
+            self.assertEqual(sorted(slow_items), sorted(fast_items))
+            for key in slow_items:
+                if hasattr(slow_items[key], "__dict__"):
+                    self.assertEqual(slow_items[key].__dict__, 
+                                     fast_items[key].__dict__)
+                    for name in slow_items[key].entries:
+                        self.assertEqual(type(getattr(slow_items[key], name)),
+                                         type(getattr(fast_items[key], name)))
+                else:
+                    self.assertEqual(slow_items[key], fast_items[key])
+
+    def test_same(self):
+        self.assertSameRead(Test_overlay.text)
+        self.assertSameRead("% just a comment\n\n" + Test_overlay.text + 
+                            "\n% the end\n")
+        self.assertSameRead("")
+
+    def test_bad(self):
+        self.assertRaises(Error, PsatData().read_fast, 
+                          StringIO(Test_overlay.text + "\nxyz\n"))
+        self.assertRaises(Error, PsatData().read_fast, StringIO("""Bus.con = [ ... 
+1 138 1 0 2;
+];
+"""))
+        # a short row then a long one mustn't shift the columns
+        self.assertRaises(Error, PsatData().read_fast, StringIO("""Bus.con = [ ... 
+2 138 1 0 2;
+3 138 1 0 2 1 1;
+];
+"""))
+
+
+class Test_index(ModifiedTestCase):
+
+    def setUp(self):
+        self.pd = PsatData()
+        self.pd.read(StringIO(Test_overlay.text))
+
+    def test_read(self):
+        self.assertEqual(self.pd.lines_by_bus,
+                         {1: set(["a1"]), 2: set(["a1", "a2"]), 3: set(["a2"])})
+        self.assertEqual(self.pd.supply_by_bus, {1: set(["g1"]), 2: set(["g2"])})
+        self.assertEqual(self.pd.bid_limit(1), (0.0, 4.0))
+        self.assertEqual(self.pd.bid_limit(3), (0.0, 0.0))
+
+    def test_islanding(self):
+        self.assertEqual(self.pd.islanding(), [])
+        psat = self.pd.overlay()
+        psat.remove_line("a2")
+        self.assertEqual(psat.islanding(), [("isolated load", [3])])
+        psat = self.pd.overlay()
+        psat.remove_line("a1")
+        self.assertEqual(psat.islanding(), [("isolated generation", [1])])
+        self.assertEqual(islanding([1, 2, 3, 4, 5], [(1, 2)], [1], [3], [3, 4]),
+                         [("split system", [3]), ("isolated load", [4]),
+                          ("isolated bus", [5])])
+
+    def test_fix_mismatches(self):
+        cases = [([], [], 1.0), ([], ["g2"], 1.0), ([], [], 0.5), 
+                 ([], ["g1"], 2.0), ([3], [], 1.0)]
+        singles, batch = [], []
+        for busses, generators, demand in cases:
+            for copies in [singles, batch]:
+                psat = self.pd.overlay()
+                psat.apply_removals(busses, [], generators)
+                psat.set_all_demand(demand)
+                copies.append(psat)
+        self.assertEqual(fix_mismatches(batch), [True, True, True, False, True])
+        for single, psat in zip(singles, batch):
+            try:
+                single.fix_mismatch()
+            except InfeasibleMismatch:
+                continue
+            self.assertEqual(sorted(single.generators), sorted(psat.generators))
+            for bus_no in single.generators:
+                self.assertAlmostEqual(single.generators[bus_no].p, 
+                                       psat.generators[bus_no].p)
+
+    def test_pickle(self):
+        pd = cPickle.loads(cPickle.dumps(self.pd, 2))
+        self.assertEqual(pd.lines_by_bus, self.pd.lines_by_bus)
+        self.assertEqual(pd.busses[1].__class__, PsatData.Bus)
+        streams = StringIO(), StringIO()
+        pd.write(streams[0])
+        self.pd.write(streams[1])
+        self.assertEqual(streams[0].getvalue(), streams[1].getvalue())
+
+    def test_remove(self):
+        over = self.pd.overlay()
+        over.remove_bus(3)
+        over.remove_generator("g2")
+        self.assertEqual(dict(over.lines_by_bus), 
+                         {1: set(["a1"]), 2: set(["a1"])})
+        self.assertEqual(over.bid_limit(2), (0.0, 0.0))
+        self.assertEqual(self.pd.lines_by_bus[2], set(["a1", "a2"]))
+        self.assertEqual(self.pd.bid_limit(2), (0.0, 4.0))
+
+    def test_virtual_cascade(self):
+        pd = PsatData()
+        pd.read(StringIO("""Bus.con = [ ... 
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+11 138 1 0 2 1;
+12 138 1 0 2 1;
+];
+
+Line.con = [ ... 
+1 2 100 138 60 0.0 0.0 0.0026 0.0139 0.4611 0.0 0.0 1.93 0.0 2.0 1; %a1
+1 11 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-1
+12 1 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-2
+];
+
+PV.con = [ ... 
+ 11 100 138 0.5 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 12 100 138 0.25 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+Supply.con = [ ... 
+ 11 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+ 12 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""))
+        pd.apply_removals([1], ["a1", "c1-1"], ["g1"])
+        self.assertEqual(set(pd.busses), set([2]))
+        self.assertEqual(len(pd.lines), 0)
+        self.assertEqual(len(pd.generators), 0)
+        self.assertEqual(len(pd.supply), 0)
+        self.assertEqual(pd.lines_by_bus, {2: set()})
+        self.assertAlmostEqual(pd.mismatch, -0.75)
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
 if __name__ == '__main__':
     unittest.main()
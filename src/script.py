@@ -27,18 +27,24 @@
 from __future__ import with_statement
 from StringIO import StringIO
 from contextlib import closing
-from copy import deepcopy
 from misc import grem, split_every, EnsureEqual, Ensure, EnsureNotEqual, Error, \
-    as_csv
+    EnsureIn, as_csv, writable
 from network_probability import NetworkProbability
-from psat_data import PsatData
+from psat_data import PsatData, Islanded, fix_mismatches
+from psat_arrays import PsatArrays
+from dc_power_flow import DCNetwork, dc_power_flow, dc_optimal_power_flow
+from ac_power_flow import ac_power_flow
 from psat_report import PsatReport
-from simulation_batch import SimulationBatch
+from simulation_batch import SimulationBatch, Scenario
+from modifiedtestcase import ModifiedTestCase
+import cPickle
+import hashlib
 import math
 import os.path
 import subprocess
 import sys
 import time
+import unittest
 
 
 
@@ -69,8 +75,8 @@ def make_outages(prob, count):
        e.g. existing outages, weather & load forcast, etc.
     """
     batch = SimulationBatch()
-    for x in range(count):
-        batch.add(prob.outages(str(x)))
+    for scenario in prob.sample_outages(count):
+        batch.add(scenario)
     EnsureEqual(count, batch.size())
     return batch
 
@@ -82,8 +88,8 @@ def make_failures(prob, count):
        e.g. new outages (failures), actual weather, actual load level, etc.
     """
     batch = SimulationBatch()
-    for x in range(count):
-        batch.add(prob.failures(str(x)))
+    for scenario in prob.sample_failures(count):
+        batch.add(scenario)
     EnsureEqual(count, batch.size())
     return batch
 
@@ -99,8 +105,11 @@ def make_outage_cases(prob, count):
     batch = SimulationBatch()
     current = 0
     while len(batch) < count:
-        batch.add(prob.outages(str(current)))
-        current += 1
+        # a sample of n can't make more than n new cases so never overshoots
+        needed = count - len(batch)
+        for scenario in prob.sample_outages(needed, current):
+            batch.add(scenario)
+        current += needed
     EnsureEqual(count, len(batch))
     return batch
 
@@ -116,16 +125,42 @@ def make_failure_cases(prob, count):
     batch = SimulationBatch()
     current = 0
     while len(batch) < count:
-        batch.add(prob.failures(str(current)))
-        current += 1
+        # a sample of n can't make more than n new cases so never overshoots
+        needed = count - len(batch)
+        for scenario in prob.sample_failures(needed, current):
+            batch.add(scenario)
+        current += needed
     EnsureEqual(count, len(batch))
     return batch
 
 
-def read_file(filename, datatype):
+def make_contingency_cases(prob, coverage=0.99, limit=None, demand=False):
+    """func make_contingency_cases :: NetworkProbability, UnitReal, Int, Bool -> SimulationBatch
+       ----
+       Enumerate the failure states in decreasing order of exact 
+       probability until they cover `coverage` of the probability (or 
+       there are `limit` of them). Each Scenario has its probability set.
+       Unlike `make_failure_cases` this isn't random, the first ones 
+       being the N-1 contingencies. With `demand` every state is repeated 
+       for each (quantised) demand level.
+    """
+    batch = SimulationBatch()
+    for scenario in prob.contingencies(coverage, limit, False, demand):
+        batch.add(scenario)
+    return batch
+
+
+# change this when a cached class changes so old caches are not used
+cache_version = 1
+
+
+def read_file(filename, datatype, method="read", cache=False):
     """func read_file            :: Str, x -> x
        ----
-       read a generic file into it class 'datatype'.
+       read a generic file into it class 'datatype' (using `method`).
+       With `cache` the result is also pickled to `filename`.cache 
+       along with the md5 of the file, and that is loaded instead of
+       reading the file again while the file hasn't changed.
     """
 
     if os.path.isfile(filename):
@@ -136,9 +171,31 @@ def read_file(filename, datatype):
         print "error finding file '%s'" % filename
         
     with open(newfilename) as thefile:
-        data = datatype()
-        data.read(thefile)
-        return data
+        text = thefile.read()
+
+    if cache:
+        key = (hashlib.md5(text).hexdigest(), datatype.__name__, method, 
+               cache_version)
+        cache_filename = newfilename + ".cache"
+        try:
+            with open(cache_filename, "rb") as cache_file:
+                cache_key, data = cPickle.load(cache_file)
+            if cache_key == key:
+                return data
+        except Exception:
+            pass
+
+    data = datatype()
+    getattr(data, method)(StringIO(text))
+
+    if cache:
+        try:
+            with open(cache_filename, "wb") as cache_file:
+                cPickle.dump((key, data), cache_file, cPickle.HIGHEST_PROTOCOL)
+        except Exception as exce:
+            print "[E] failed to write cache '%s'" % cache_filename
+            print exce
+    return data
 
 
 def read_probabilities(filename):
@@ -146,7 +203,7 @@ def read_probabilities(filename):
        ----
        read a net_file into NetworkProbability.
     """
-    return read_file(filename, NetworkProbability)
+    return read_file(filename, NetworkProbability, cache=True)
     
 
 def read_psat(filename):
@@ -154,7 +211,7 @@ def read_psat(filename):
        ----
        read a psat_file into PsatData.
     """
-    return read_file(filename, PsatData)
+    return read_file(filename, PsatData, "read_fast", cache=True)
 
 
 def read_batch(filename):
@@ -203,23 +260,25 @@ def report_to_psat(report, psat):
     # assert len(psat.demand) == 0
     # assert len(psat.supply) == len(psat.loads)
 
-    new_psat = deepcopy(psat)
+    new_psat = psat.overlay()
     pf = report.power_flow
 
     EnsureEqual(len(new_psat.slack), 1)
-    slack = new_psat.slack.values()[0]
+    slack = writable(new_psat.slack, new_psat.slack.keys()[0])
     slack.v_magnitude = float(pf[slack.bus_no].v)
     slack.ref_angle = float(pf[slack.bus_no].phase)
     slack.p_guess = float(pf[slack.bus_no].pg)
 
-    for gen in new_psat.generators.values():
+    for key in new_psat.generators.keys():
+        gen = writable(new_psat.generators, key)
         if gen.bus_no in pf:
             gen.p = float(pf[gen.bus_no].pg)
             gen.v = float(pf[gen.bus_no].v)
         else:
             print "ERROR:", gen.bus_no
 
-    for load in new_psat.loads.values():
+    for key in new_psat.loads.keys():
+        load = writable(new_psat.loads, key)
         if load.bus_no in pf:
             load.p = float(pf[load.bus_no].pl)
             load.q = float(pf[load.bus_no].ql)
@@ -257,42 +316,156 @@ def text_to_scenario(text):
     return list(batch)[0]
 
 
-def scenario_to_psat(scenario, psat):
+def scenario_to_psat(scenario, psat, fix=True):
     """func scenario_to_psat     :: Scenario, PsatData -> PsatData
        ----
        Make a new PsatData based upon `psat` but contains the changes
        specified in the scenario.
+       Raises Islanded if it splits the network, which would not solve.
+       Without `fix` the mismatch is left for psat_data.fix_mismatches.
     """
 
-    new_psat = deepcopy(psat)
+    new_psat = psat.overlay()
 
-    for kill in scenario.kill_bus:
-        new_psat.remove_bus(kill)
-    for kill in scenario.kill_line:
-        new_psat.remove_line(kill)
-    for kill in scenario.kill_gen:
-        new_psat.remove_generator(kill)
+    new_psat.apply_removals(scenario.kill_bus, scenario.kill_line, 
+                            scenario.kill_gen)
+    islands = new_psat.islanding()
+    if islands:
+        raise Islanded(islands)
     if scenario.all_demand:
         new_psat.set_all_demand(scenario.all_demand)
 
-    new_psat.fix_mismatch()
+    if fix:
+        new_psat.fix_mismatch()
     return new_psat
 
 
-def batch_simulate(batch, psat, size=10, clean=True, mismatch_file=None):
+def batch_simulate(batch, psat, size=10, clean=True, mismatch_file=None, 
+                   cache=None, symmetry=None, backend="matlab", screen=None):
     """func batch_simulate       :: SimulationBatch, PsatData, Int -> 
        ----
        Simulate all Scenarios in `batch` (with a base of `psat`) in groups
        of size `size`. Modify `batch` in place. delete all temp files
        if it succedes 
 
+       `cache` is a dict of Scenario.dicthash to result for scenarios 
+       already simulated on this `psat`; they are not simulated again 
+       and the new pass or fail results are added to it (not errors).
+
+       With a GeneratorSymmetry of `psat` only one of each set of 
+       equivalent scenarios is simulated and the others get its result
+       (the cache is then keyed by GeneratorSymmetry.dicthash).
+
+       Scenarios that island the network, or whose generators can't 
+       take up the change in demand, fail without being simulated.
+
+       `backend` is "matlab" or one of `backends` to simulate them 
+       without Matlab (and without writing any files). These work on a
+       PsatData so a PsatArrays `psat` is converted to one first.
+
+       With a LineSensitivity of `psat` as `screen` the scenarios that
+       only remove lines get its DC result rather than being simulated.
     """
 
-    print "[b] batch simulate %d cases" % len(batch)
-    for n, group in enumerate(split_every(size, batch)):
+    EnsureIn(backend, ["matlab"] + backends.keys(), "unknown backend")
+    if backend != "matlab" and isinstance(psat, PsatArrays):
+        psat = psat.to_psat()
+
+    if symmetry is not None:
+        key = symmetry.dicthash
+    else:
+        key = lambda scenario: scenario.dicthash()
+
+    if cache is not None:
+        for scenario in batch:
+            scenario.result = cache.get(key(scenario))
+        todo = [scenario for scenario in batch if not scenario.result]
+        print "[b] %d of %d cases cached" % (len(batch) - len(todo), len(batch))
+        batch = todo
+
+    # simulate the first of each set of equivalent scenarios
+    equivalent = {}
+    representatives = []
+    for scenario in batch:
+        members = equivalent.setdefault(key(scenario), [])
+        if not members:
+            representatives.append(scenario)
+        members.append(scenario)
+    if len(representatives) != len(batch):
+        print "[b] %d cases equivalent to %d" % (len(batch), len(representatives))
+    batch = representatives
+
+    todo = batch
+    if screen is not None:
+        todo = screen.screen(batch)
+        print "[b] %d cases screened" % (len(batch) - len(todo))
+
+    # convert them all first so islanded ones don't go to matlab
+    converted = []
+    for scenario in todo:
+        scenario.result = None
+        try:
+            converted.append((scenario, scenario_to_psat(scenario, psat, fix=False)))
+        except Islanded as exce:
+            print "[b] %s (%s)" % (exce.msg, scenario.title)
+            scenario.result = "fail"
+        except Exception as exce:
+            print "[E] Error Caught at script.batch_simulate (%s) - failed to convert scenario to psat" % scenario.title
+            print exce
+            scenario.result = "error"
+            # we probably shouldn't have this but it might cause error in matlab as it is expected.
+            converted.append((scenario, psat))
+    if len(converted) != len(todo):
+        print "[b] %d cases islanded" % (len(todo) - len(converted))
+
+    # then fix the mismatch of them all at once, dropping the infeasible
+    to_fix = [(scenario, new_psat) for scenario, new_psat in converted 
+              if not scenario.result]
+    feasible = fix_mismatches([new_psat for _, new_psat in to_fix])
+    for (scenario, new_psat), ok in zip(to_fix, feasible):
+        if not ok:
+            print "[b] generation can't meet demand (%s)" % scenario.title
+            scenario.result = "fail"
+        elif not new_psat.in_limits():
+            print "[E] Error Caught at script.batch_simulate (%s) - fixing mismatch should leave it in limit" % scenario.title
+            scenario.result = "error"
+    simulated = [(scenario, new_psat) if scenario.result != "error" else (scenario, psat)
+                 for scenario, new_psat in converted if scenario.result != "fail"]
+
+    print "[b] batch simulate %d cases" % len(simulated)
+    if backend == "matlab":
+        matlab_batch_simulate(simulated, size, mismatch_file)
+    else:
+        # factorise the base network once for all the scenarios
+        try:
+            base = DCNetwork(psat)
+        except Islanded:
+            base = None
+        native_batch_simulate(simulated, backends[backend], mismatch_file, base)
+
+    for scenario in batch:
+        for other in equivalent[key(scenario)]:
+            other.result = scenario.result
+        # errors may be transient so they are tried again next time
+        if cache is not None and scenario.result in ("pass", "fail"):
+            cache[key(scenario)] = scenario.result
+
+    if clean:
+        clean_files()
+
+
+def matlab_batch_simulate(psat_cases, size, mismatch_file=None):
+    """func matlab_batch_simulate :: [(Scenario, PsatData)], Int -> 
+       ----
+       Simulate each (Scenario, PsatData) pair in Matlab in groups of
+       `size`, setting the result of the scenarios.
+    """
+
+    for n, psat_group in enumerate(split_every(size, psat_cases)):
+        group = [scenario for scenario, _ in psat_group]
         try:
             timer_start = time.clock()
-            print "[b] simulating batch", n + 1, "of", int(math.ceil(len(batch) / size)) + 1
+            print "[b] simulating batch", n + 1, "of", int(math.ceil(len(psat_cases) / size)) + 1
             sys.stdout.flush()
          
             # make the matlab_script
@@ -300,18 +473,7 @@ def batch_simulate(batch, psat, size=10, clean=True, mismatch_file=None):
             batch_matlab_script(matlab_filename + ".m", group)
             
             # write all the scenarios to file as psat_files
-            for scenario in group:
-                scenario.result = None
-    
-                try:
-                    new_psat = scenario_to_psat(scenario, psat)
-                except Exception as exce:
-                    print "[E] Error Caught at script.batch_simulate (%s) - failed to convert scenario to psat" % scenario.title
-                    print exce
-                    scenario.result = "error"
-                    # we probably shouldn't have this but it might cause error in matlab as it is expected.
-                    new_psat = deepcopy(psat)
-                
+            for scenario, new_psat in psat_group:
                 if mismatch_file:
                     mismatch_file.write(as_csv([scenario.title] + list(new_psat.get_stats())) + "\n")
     
@@ -335,7 +497,7 @@ def batch_simulate(batch, psat, size=10, clean=True, mismatch_file=None):
                         report = read_report(report_filename)
                         scenario.result = report_in_limits(report)
                     except Exception as exce:
-                        print "[E] Error Caught at script.batch_simulate (%s) - report check failure" % scenario.title
+                        print "[E] Error Caught at script.matlab_batch_simulate (%s) - report check failure" % scenario.title
                         print exce
                         scenario.result = "error"
                     
@@ -343,11 +505,70 @@ def batch_simulate(batch, psat, size=10, clean=True, mismatch_file=None):
             timer_time = (timer_end - timer_start)
             print "[b] batch time of", int(math.ceil(timer_time)), "seconds"
         except Exception as exce:
-            print "[E] Error Caught at script.batch_simulate (%s) - failed to simulate batch" % scenario.title
+            print "[E] Error Caught at script.matlab_batch_simulate (%s) - failed to simulate batch" % scenario.title
             print exce
 
-    if clean:
-        clean_files()
+
+def dc_simulate(psat, simtype, base=None):
+    """func dc_simulate          :: PsatData, Str, DCNetwork -> PsatReport
+       ----
+       the DC power flow (pf) or optimal power flow (opf) of `psat` 
+       (see dc_power_flow.py), updating the factorisation of the `base`
+       DCNetwork if given.
+    """
+    EnsureIn(simtype, ["pf", "opf"], "expected pf or opf")
+    if simtype == "opf":
+        return dc_optimal_power_flow(psat, base)
+    return dc_power_flow(psat, base)
+
+
+def ac_simulate(psat, simtype, base=None):
+    """func ac_simulate          :: PsatData, Str, DCNetwork -> PsatReport
+       ----
+       the Newton-Raphson power flow of `psat` (see ac_power_flow.py). 
+       For opf that of the DC optimal dispatch, or the failed DC report
+       if there is none. `base` is only used for the DC dispatch.
+    """
+    EnsureIn(simtype, ["pf", "opf"], "expected pf or opf")
+    if simtype == "opf":
+        optimal = dc_optimal_power_flow(psat, base)
+        if not optimal.in_limit():
+            return optimal
+        psat = report_to_psat(optimal, psat)
+    return ac_power_flow(psat, max_iterations=50)
+
+
+# simulators that don't need Matlab, by the `backend` name used in 
+# batch_simulate: each is PsatData, simtype, base DCNetwork -> PsatReport.
+backends = {"dc": dc_simulate, 
+            "ac": ac_simulate}
+
+
+def native_batch_simulate(psat_cases, simulator, mismatch_file=None, base=None):
+    """func native_batch_simulate :: [(Scenario, PsatData)], Func -> 
+       ----
+       Simulate each (Scenario, PsatData) pair with `simulator` (one of
+       `backends`) in this process, setting the result of the scenarios.
+       Those with a result already (errors) are skipped. `base` is the
+       DCNetwork of the psat they were made from, if there is one.
+    """
+
+    timer_start = time.clock()
+    for scenario, new_psat in psat_cases:
+        if mismatch_file:
+            mismatch_file.write(as_csv([scenario.title] + list(new_psat.get_stats())) + "\n")
+        if scenario.result:
+            continue
+        try:
+            scenario.result = report_in_limits(simulator(new_psat, scenario.simtype, base))
+        except Islanded as exce:
+            print "[b] %s (%s)" % (exce.msg, scenario.title)
+            scenario.result = "fail"
+        except Exception as exce:
+            print "[E] Error Caught at script.native_batch_simulate (%s) - simulation failure" % scenario.title
+            print exce
+            scenario.result = "error"
+    print "[b] batch time of %f seconds" % (time.clock() - timer_start)
 
 
 def single_simulate(psat, simtype, title, clean=True):
@@ -381,15 +602,19 @@ def single_simulate(psat, simtype, title, clean=True):
     return report
 
 
-def simulate_scenario(psat, scenario, clean=True):
-    """func simulate_scenario   :: PsatData, Scenario, Bool -> PsatReport
+def simulate_scenario(psat, scenario, clean=True, backend="matlab"):
+    """func simulate_scenario   :: PsatData, Scenario, Bool, Str -> PsatReport
        ----
        make PsatData with `scenario` and `psat`. simulate it and 
        return the report. 
        remove temp files if specified
+       `backend` is "matlab" or one of `backends`
     """
 
+    EnsureIn(backend, ["matlab"] + backends.keys(), "unknown backend")
     new_psat = scenario_to_psat(scenario, psat)
+    if backend != "matlab":
+        return backends[backend](new_psat, scenario.simtype)
     return single_simulate(new_psat, scenario.simtype, scenario.title, clean)
 
 
@@ -552,3 +777,64 @@ def simulate(matlab_filename, single_item=True):
 # 
 #==============================================================================
 
+
+class Test_batch_simulate(ModifiedTestCase):
+
+    def test_cache_errors(self):
+        import dc_power_flow
+        psat = PsatData()
+        psat.read(StringIO(dc_power_flow.Test_dc_power_flow.text))
+        good = Scenario("good")
+        bad = Scenario("bad")
+        bad.kill_bus = [1]  # the slack, so it can't be converted
+        batch = SimulationBatch()
+        batch.add(good)
+        batch.add(bad)
+        cache = {}
+        batch_simulate(batch, psat, clean=False, cache=cache, backend="dc")
+        self.assertEqual((good.result, bad.result), ("pass", "error"))
+        self.assertEqual(cache, {good.dicthash(): "pass"})
+
+    def test_psat_arrays(self):
+        import dc_power_flow
+        psat = PsatData()
+        psat.read(StringIO(dc_power_flow.Test_dc_power_flow.text))
+        psat.lines["a2"].s_limit = 1.0
+        batch = SimulationBatch()
+        for title, lines in (("base", []), ("a3", ["a3"]), ("a1", ["a1"])):
+            scenario = Scenario(title)
+            scenario.kill_line = lines
+            batch.add(scenario)
+        expected = [report_in_limits(dc_power_flow.dc_power_flow(
+                        scenario_to_psat(x, psat))) for x in batch]
+        batch_simulate(batch, PsatArrays(psat), clean=False, backend="dc")
+        self.assertEqual([x.result for x in batch], expected)
+        self.assertTrue("fail" in expected and "pass" in expected)
+
+
+class Test_adaptive(ModifiedTestCase):
+
+    class NoFailures(object):
+        """a NetworkProbability that never samples a failure"""
+        def sample_failures(self, count, start=0):
+            return [Scenario("failure%d" % start, "pf", count)]
+
+    def test_no_failures(self):
+        import dc_power_flow
+        from main import adaptive_failure_cases
+        psat = PsatData()
+        psat.read(StringIO(dc_power_flow.Test_dc_power_flow.text))
+        batch = adaptive_failure_cases(self.NoFailures(), psat, 10, 
+                                       target_cov=0.1, max_steps=3, 
+                                       backend="dc")
+        self.assertEqual(batch.size(), 30)
+        self.assertEqual([x.result for x in batch], ["pass"])
+
+
+#==============================================================================
+# 
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
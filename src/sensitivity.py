@@ -0,0 +1,287 @@
+#! /usr/local/bin/python
+# sensitivity.py - LineSensitivity
+
+#==============================================================================
+# Copyright (C) 2010 James Brooks (kerspoon)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANDABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#==============================================================================
+
+"""
+by James Brooks 2010
+sensitivity.py - LineSensitivity
+
+Power transfer & line outage distribution factors of the DC model of a
+PsatData, so the flows after losing a few lines come from small dense
+updates of the base case flows rather than a new power flow.
+"""
+
+#==============================================================================
+#  Imports:
+#==============================================================================
+
+from dc_power_flow import DCNetwork, dc_power_flow
+from psat_data import PsatData, fix_mismatches
+from simulation_batch import Scenario, components
+from modifiedtestcase import ModifiedTestCase
+from StringIO import StringIO
+import numpy
+import unittest
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class LineSensitivity(object):
+    """
+    The DC flows of a PsatData and how they change when lines are lost.
+
+    `transfer` (line x line) is the change in the flow on each line for
+    a unit of power sent from one end of a line to the other. With the
+    set of lines K lost the flows are
+
+        f = f0 + transfer[:, K] (I - transfer[K, K])^-1 f0[K]
+
+    which splits the network if I - transfer[K, K] is singular.
+    """
+
+    def __init__(self, psat, tolerance=1e-10):
+        self.psat = psat
+        self.network = network = DCNetwork(psat)
+        self.tolerance = tolerance
+        self.line_index = network.line_index
+        self.angles, self.flows = network.solve(network.injection(psat))
+        self.ptdf = network.ptdf()
+        self.transfer = self.ptdf[:, network.fbus] - self.ptdf[:, network.tbus]
+        self.demand_flows = {None: self.flows}
+
+    def flows_at(self, all_demand):
+        """the base flows with `all_demand` set (as scenario_to_psat and
+           fix_mismatches would) or None if generation can't meet it"""
+        if all_demand not in self.demand_flows:
+            psat = self.psat.overlay()
+            psat.set_all_demand(all_demand)
+            flows = None
+            if fix_mismatches([psat])[0] and psat.in_limits():
+                flows = self.network.solve(self.network.injection(psat))[1]
+            self.demand_flows[all_demand] = flows
+        return self.demand_flows[all_demand]
+
+    def lodf(self):
+        """the line outage distribution factors (line x line): the share
+           of the flow on each line that moves to the others when it is
+           lost (-1 on the diagonal). Lines that would split the network
+           are nan."""
+        remain = 1.0 - self.transfer.diagonal()
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            factors = self.transfer / numpy.where(
+                abs(remain) < self.tolerance, numpy.nan, remain)
+        numpy.fill_diagonal(factors, -1.0)
+        return factors
+
+    def outage_flows(self, line_ids):
+        """the flows (by line, lost ones 0) without the `line_ids` or
+           None if losing them splits the network"""
+        flows, split = self.batch_outage_flows(
+            numpy.array([[self.line_index[x] for x in line_ids]], int))
+        if split[0]:
+            return None
+        return flows[0]
+
+    def batch_outage_flows(self, lost, base=None):
+        """the flows (scenario x line) for each row of `lost` (scenario x k
+           line indexes) and whether each splits the network (whose flows
+           are then nan). From the `base` flows if not those of the psat."""
+        if base is None:
+            base = self.flows
+        count, k = lost.shape
+        flows = numpy.tile(base, (count, 1))
+        if k == 0:
+            return flows, numpy.zeros(count, bool)
+
+        # each scenario's k x k system at once
+        matrix = numpy.eye(k) - self.transfer[lost[:, :, None], lost[:, None, :]]
+        split = abs(numpy.linalg.det(matrix)) < self.tolerance
+        ok = ~split
+        shares = numpy.linalg.solve(matrix[ok], base[lost[ok]][:, :, None])
+        flows[ok] += numpy.einsum("lnk,nk->nl", self.transfer[:, lost[ok]],
+                                  shares[:, :, 0])
+        flows[numpy.arange(count)[:, None], lost] = 0.0
+        flows[split] = numpy.nan
+        return flows, split
+
+    def overloaded(self, flows):
+        """which rows of `flows` (scenario x line) have a line over its limit"""
+        return (abs(flows) > self.network.limit).any(axis=1)
+
+    def screen(self, scenarios, chunk=1000):
+        """set the result of the "pf" `scenarios` that only remove lines
+           (that this psat has) and maybe set the demand to what a DC power
+           flow would give: fail if they split the network or overload a
+           line, else pass. Returns the scenarios it can't say anything
+           about."""
+
+        other_kinds = ~components.kind_masks["line"]
+        groups = {}
+        rest = []
+        for scenario in scenarios:
+            if scenario.simtype != "pf" or scenario.mask & other_kinds:
+                rest.append(scenario)
+                continue
+            lost = [self.line_index.get(x) for x in scenario.kill_line]
+            if None in lost or self.flows_at(scenario.all_demand) is None:
+                rest.append(scenario)
+                continue
+            key = (scenario.all_demand, len(lost))
+            groups.setdefault(key, []).append((scenario, lost))
+
+        for (all_demand, k), group in groups.items():
+            for start in range(0, len(group), chunk):
+                part = group[start:start + chunk]
+                lost = numpy.array([x[1] for x in part], int).reshape(len(part), k)
+                flows, split = self.batch_outage_flows(
+                    lost, self.flows_at(all_demand))
+                split[~split] = self.overloaded(flows[~split])
+                for (scenario, _), fail in zip(part, split):
+                    scenario.result = "fail" if fail else "pass"
+        return rest
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_sensitivity(ModifiedTestCase):
+
+    text = """Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+3 138 1 0 2 1;
+4 138 1 0 2 1;
+5 138 1 0 2 1;
+];
+
+Line.con = [ ...
+1 2 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a1
+2 3 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a2
+1 3 100 138 60 0.0 0.0 0.0 0.2 0.0 0.0 0.0 0.0 0.0 1.0 1; %a3
+3 4 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a4
+1 4 100 138 60 0.0 0.0 0.0 0.3 0.0 0.0 0.0 0.0 0.0 1.0 1; %a5
+4 5 100 138 60 0.0 0.0 0.0 0.1 0.0 0.0 0.0 0.0 0.0 1.0 1; %a6
+2 4 100 138 60 0.0 0.0 0.0 0.2 0.0 0.0 0.0 0.0 0.0 1.0 1; %a7
+];
+
+SW.con = [ ...
+1 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+PV.con = [ ...
+2 100 138 0.5 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];
+
+PQ.con = [ ...
+3 100 138 0.9 0.10 1.05 0.95 1 1;
+5 100 138 0.3 0.10 1.05 0.95 1 1;
+];
+
+Demand.con = [ ...
+3 100 0.9 0.1 0.9 0.9 0 0 20 0 0 0 0 0 0 0 0 1;
+5 100 0.3 0.1 0.3 0.3 0 0 20 0 0 0 0 0 0 0 0 1;
+];
+
+Supply.con = [ ...
+1 100 0.1 2.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+2 100 0.1 1.0 0.0 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+];
+"""
+
+    def setUp(self):
+        self.psat = PsatData()
+        self.psat.read(StringIO(self.text))
+        self.sensitivity = LineSensitivity(self.psat)
+
+    def resolved(self, line_ids):
+        psat = self.psat.overlay()
+        psat.apply_removals((), line_ids, ())
+        return dc_power_flow(psat).line_flow
+
+    def test_outage_flows(self):
+        for lost in (["a1"], ["a3"], ["a2", "a5"], ["a1", "a3", "a4"]):
+            flows = self.sensitivity.outage_flows(lost)
+            expected = self.resolved(lost)
+            for n, cid in enumerate(self.sensitivity.network.line_ids):
+                self.assertAlmostEqual(flows[n], expected.get(cid, 0.0))
+
+    def test_lodf(self):
+        lodf = self.sensitivity.lodf()
+        index = self.sensitivity.line_index
+        base = self.sensitivity.flows
+        expected = self.resolved(["a3"])
+        self.assertAlmostEqual(base[index["a1"]] +
+                               lodf[index["a1"], index["a3"]] * base[index["a3"]],
+                               expected["a1"])
+        self.assertTrue(numpy.isnan(lodf[index["a1"], index["a6"]]))
+
+    def test_split(self):
+        self.assertEqual(self.sensitivity.outage_flows(["a6"]), None)
+        self.assertEqual(self.sensitivity.outage_flows(["a4", "a5", "a7"]), None)
+
+    def test_screen(self):
+        scenarios = []
+        for lost in ([], ["a1"], ["a6"], ["a2", "a3"], ["a3", "a5"],
+                     ["a2", "a4", "a7"]):
+            scenario = Scenario("x")
+            scenario.kill_line = lost
+            scenarios.append(scenario)
+        demand = Scenario("w")
+        demand.kill_line = ["a3"]
+        demand.all_demand = 1.2
+        scenarios.append(demand)
+        other = Scenario("y")
+        other.kill_gen = ["g1"]
+        opf = Scenario("z", "opf")
+        self.psat.lines["a2"].s_limit = 0.7
+        sensitivity = LineSensitivity(self.psat)
+        self.assertEqual(sensitivity.screen(scenarios + [other, opf]), [other, opf])
+        for scenario in scenarios:
+            psat = self.psat.overlay()
+            psat.apply_removals((), scenario.kill_line, ())
+            if scenario.all_demand:
+                psat.set_all_demand(scenario.all_demand)
+                psat.fix_mismatch()
+            if psat.islanding():
+                self.assertEqual(scenario.result, "fail")
+            else:
+                self.assertEqual(scenario.result,
+                                 "pass" if dc_power_flow(psat).in_limit() else "fail")
+        # a6 splits the network, losing a3 & a5 overloads a2 as does a3
+        # with more demand
+        self.assertEqual([x.result for x in scenarios],
+                         ["pass", "pass", "fail", "pass", "fail", "pass", "fail"])
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+#==============================================================================
+#
+#==============================================================================
@@ -30,9 +30,12 @@ simulation_batch.py - SimulationBatch - batch_file - batch
 from StringIO import StringIO
 from misc import as_csv, Ensure, EnsureIn, EnsureEqual, Error
 from modifiedtestcase import ModifiedTestCase
-import collections
+import math
 import unittest
 
+simtypes = frozenset(["pf", "opf"])
+results = frozenset(["pass", "fail", "error"])
+
 #==============================================================================
 #  eBNF
 #==============================================================================
@@ -46,6 +49,8 @@ import unittest
 # infoline ::= 'remove line' Cid
 # infoline ::= 'remove generator' Cid
 # infoline ::= 'set all demand' Real
+# infoline ::= 'weight' Real
+# infoline ::= 'probability' Real
 # infoline ::= 'result' ('pass' | 'fail' | 'error')
 # 
 # type BusNo -> PInt
@@ -73,24 +78,135 @@ import unittest
 #==============================================================================
 
 
+class ComponentIndex(object):
+    """interns (kind, name) pairs as bit positions so that a set of 
+       killed components is a single integer. Bits are given out in the
+       order components are first seen and never reused.
+    """
+
+    kinds = ("bus", "line", "generator")
+
+    def __init__(self):
+        self.bits = {}
+        self.names = []
+        self.kind_masks = dict((kind, 0) for kind in self.kinds)
+
+    def bit(self, kind, name):
+        """the mask with just the bit of component `name` set"""
+        key = (kind, name)
+        bit = self.bits.get(key)
+        if bit is None:
+            EnsureIn(kind, self.kind_masks)
+            bit = 1 << len(self.names)
+            self.bits[key] = bit
+            self.names.append(name)
+            self.kind_masks[kind] |= bit
+        return bit
+
+    def mask(self, kind, names):
+        mask = 0
+        for name in names:
+            mask |= self.bit(kind, name)
+        return mask
+
+    def decode(self, kind, mask):
+        """the sorted names of components of `kind` set in `mask`. As 
+           they are sorted it doesn't matter what order they were killed
+           (or interned) in.
+        """
+        mask &= self.kind_masks[kind]
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        names.sort()
+        return names
+
+components = ComponentIndex()
+
+
+class KillList(list):
+    """the killed components of one kind of a Scenario; changing it in
+       any way changes the Scenario's mask. It can't be changed once the
+       Scenario's kills of that kind have been changed by other means.
+    """
+
+    def __init__(self, scenario, kind):
+        list.__init__(self, components.decode(kind, scenario.mask))
+        self.scenario = scenario
+        self.kind = kind
+        self.known = scenario.mask & components.kind_masks[kind]
+
+    def mutator(method):
+        def wrapper(self, *args):
+            kind_mask = components.kind_masks[self.kind]
+            Ensure(self.scenario.mask & kind_mask == self.known, 
+                   "the Scenario's kills changed since this list was made")
+            result = method(self, *args)
+            # the names may be new so the kind's mask must be found after
+            self.known = components.mask(self.kind, self)
+            kind_mask = components.kind_masks[self.kind]
+            self.scenario.mask = (self.scenario.mask & ~kind_mask) | self.known
+            return result
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    append = mutator(list.append)
+    extend = mutator(list.extend)
+    insert = mutator(list.insert)
+    remove = mutator(list.remove)
+    pop = mutator(list.pop)
+    __setitem__ = mutator(list.__setitem__)
+    __delitem__ = mutator(list.__delitem__)
+    __setslice__ = mutator(list.__setslice__)
+    __delslice__ = mutator(list.__delslice__)
+    __iadd__ = mutator(list.__iadd__)
+    __imul__ = mutator(list.__imul__)
+    del mutator
+
+
+def kill_property(kind):
+    def getter(self):
+        return KillList(self, kind)
+    def setter(self, names):
+        self.mask = ((self.mask & ~components.kind_masks[kind]) | 
+                     components.mask(kind, names))
+    return property(getter, setter)
+
+
 class Scenario(object):
+    """the killed busses, lines and generators are kept as one integer
+       `mask` over `components`; `kill_bus` etc. are views of it.
+    """
+
+    __slots__ = ("title", "simtype", "count", "mask", "all_demand", 
+                 "weight", "probability", "result")
 
     def __init__(self, title, simtype="pf", count=1):
         self.title = title
         self.simtype = simtype
         self.count = count
-        self.kill_bus = []
-        self.kill_gen = []
-        self.kill_line = []
+        self.mask = 0
         self.all_demand = None
+        self.weight = 1.0
+        self.probability = None
         self.result = None
 
+    kill_bus = kill_property("bus")
+    kill_line = kill_property("line")
+    kill_gen = kill_property("generator")
+
+    def kill(self, kind, name):
+        self.mask |= components.bit(kind, name)
+
     def invariant(self):
         Ensure(len(self.title) > 0, "Scenarios must have a title")
         Ensure(self.count > 0, "Scenarios must have a count")
-        EnsureIn(self.simtype, set(["pf", "opf"]))
+        Ensure(self.weight >= 0, "Scenarios must have a positive weight")
+        EnsureIn(self.simtype, simtypes)
         if self.result:
-            EnsureIn(self.result, set(["pass", "fail", "error"]))
+            EnsureIn(self.result, results)
 
     def write(self, stream):
         self.invariant()
@@ -110,6 +226,10 @@ class Scenario(object):
             stream.write("  remove generator " + kill + "\n")
         if self.all_demand:
             stream.write("  set all demand " + str(self.all_demand) + "\n")
+        if self.weight != 1.0:
+            stream.write("  weight " + repr(self.weight) + "\n")
+        if self.probability is not None:
+            stream.write("  probability " + repr(self.probability) + "\n")
         if self.result:
             stream.write("  result " + self.result + "\n")
 
@@ -121,29 +241,24 @@ class Scenario(object):
         stream.write(as_csv(infoline + kills, "\t") + "\n")
 
     def num_kills(self):
-        return len(self.kill_bus) + len(self.kill_gen) + len(self.kill_line)
+        return bin(self.mask).count("1")
 
     def dicthash(self):
-        """returns a text of the csv value *without* the count title or 
-           result. To be used to store a Scenario in a dict"""
-        self.invariant()
-        infoline = [self.simtype, self.all_demand]
-        kills = self.kill_bus + self.kill_line + self.kill_gen
-        return as_csv(infoline + kills, "\t")
+        """returns the key *without* the count title or result. To be 
+           used to store a Scenario in a dict"""
+        return (self.simtype, self.all_demand, self.mask)
 
     def equal(self, other):
         """doesn't compare: count, result, or title"""
-        self.invariant()
-        other.invariant()
-        if self.simtype != other.simtype: return False
-        if self.all_demand != other.all_demand: return False
-        if self.kill_bus != other.kill_bus: return False
-        if self.kill_line != other.kill_line: return False
-        if self.kill_gen != other.kill_gen: return False
-        return True
-
-    def increment(self, val=1):
+        return self.dicthash() == other.dicthash()
+
+    def increment(self, val=1, weight=1.0):
+        """add `val` more samples of this scenario each with a likelihood
+           ratio of `weight`; our weight becomes the mean of all of them.
+        """
+        total = self.count * self.weight + val * weight
         self.count += val
+        self.weight = total / self.count
 
 
 #==============================================================================
@@ -182,10 +297,6 @@ class SimulationBatch(object):
             # print "Updated [%d] = %s" % (self.scenarios[dicthash].count+1, 
             #                              dicthash)
 
-            # make sure we don't have hash collision
-            Ensure(self.scenarios[dicthash].equal(scenario),
-                   "we have a hash collision")
-
             # make sure we keep result info
             if scenario.result:
                 if self.scenarios[dicthash].result:
@@ -194,7 +305,14 @@ class SimulationBatch(object):
                 else:
                     self.scenarios[dicthash].result = scenario.result
 
-            self.scenarios[dicthash].increment(scenario.count)
+            # an exact probability is the sum of its parts
+            if scenario.probability is not None:
+                existing = self.scenarios[dicthash].probability or 0.0
+                self.scenarios[dicthash].probability = (existing + 
+                                                        scenario.probability)
+
+            self.scenarios[dicthash].increment(scenario.count, 
+                                               scenario.weight)
         else:
             # print "New [1]", dicthash
             self.scenarios[dicthash] = scenario
@@ -234,7 +352,7 @@ class SimulationBatch(object):
                     EnsureEqual(len(line), 2)
                     count = 1
 
-                EnsureIn(simtype, set("pf opf".split()))
+                EnsureIn(simtype, simtypes)
                 current_scen = Scenario(title, simtype, count)
 
             # remove 
@@ -256,52 +374,104 @@ class SimulationBatch(object):
                 else:
                     raise Error("got %s expected 'demand'" % line[1])
                 
+            # importance sampling weight
+            elif line[0] == "weight":
+                current_scen.weight = float(line[1])
+
+            # exact probability
+            elif line[0] == "probability":
+                current_scen.probability = float(line[1])
+
             # results 
             elif line[0] == "result":
-                EnsureIn(line[1], set("pass fail error".split()))
+                EnsureIn(line[1], results)
                 current_scen.result = line[1]
 
             # nothing else allowed
             else:
-                raise Error("got %s expected (remove, set, result, [])" % line[0])
+                raise Error("got %s expected (remove, set, weight, probability, result, [])" % line[0])
 
 
         if current_scen is not None:
             # logger.debug("Added Scenario: %s" % title)
             self.add(current_scen)
 
+    def probability(self, select):
+        """func probability :: (Scenario -> Bool) -> (Real, Real)
+           ----
+           an unbiased estimate of the probability of the scenarios for 
+           which `select` is True and its standard error. Each sample
+           counts as its weight (1 unless importance sampled).
+           If every scenario has an exact probability (i.e. they were
+           enumerated) it is their sum, with no error.
+        """
+
+        stats = self.probabilities(lambda scen: bool(select(scen)))
+        return stats.get(True, (0, 0.0, 0.0))[1:]
+
+    def probabilities(self, key):
+        """func probabilities :: (Scenario -> a) -> {a: (Int, Real, Real)}
+           ----
+           the number of samples, probability & standard error (as from
+           `probability`) of the scenarios with each value of `key`, in
+           one pass over the batch.
+        """
+
+        size = self.size()
+        enumerated = all(scen.probability is not None for scen in self)
+
+        # value -> [count, exact, total, square]
+        sums = {}
+        for scen in self:
+            value = key(scen)
+            if value not in sums:
+                sums[value] = [0, 0.0, 0.0, 0.0]
+            entry = sums[value]
+            entry[0] += scen.count
+            if enumerated:
+                entry[1] += scen.probability
+            else:
+                entry[2] += scen.count * scen.weight
+                entry[3] += scen.count * scen.weight ** 2
+
+        result = {}
+        for value, (count, exact, total, square) in sums.items():
+            if enumerated:
+                result[value] = (count, exact, 0.0)
+                continue
+            mean = total / size
+            if size == 1:
+                result[value] = (count, mean, 0.0)
+                continue
+            variance = max(square / size - mean ** 2, 0.0) * size / (size - 1)
+            result[value] = (count, mean, math.sqrt(variance / size))
+        return result
+
     def write_stats(self, stream):
 
         stream.write("batch\t%d\t%d\n" % (self.size(), len(self)))
         
-        result_count = collections.defaultdict(int)
-        fail_count = collections.defaultdict(int)
-
-        bus_count = collections.defaultdict(int)
-        line_count = collections.defaultdict(int)
-        gen_count = collections.defaultdict(int)
-
-        for scen in self:
-            fail_count[scen.num_kills()] += scen.count
-            result_count[str(scen.result)] += scen.count
-            bus_count[len(scen.kill_bus)] += scen.count
-            line_count[len(scen.kill_line)] += scen.count
-            gen_count[len(scen.kill_gen)] += scen.count
-
-        stream.write("Failures\tOccurance\n")
-        map(lambda x: stream.write("%d\t%d\n" % x), fail_count.items())
-        stream.write("\n")
-        stream.write("Result\tOccurance\n")
-        map(lambda x: stream.write("%s\t%d\n" % x), result_count.items())
-        stream.write("\n")
-        stream.write("Bus\tOccurance\n")
-        map(lambda x: stream.write("%d\t%d\n" % x), bus_count.items())
-        stream.write("\n")
-        stream.write("Line\tOccurance\n")
-        map(lambda x: stream.write("%d\t%d\n" % x), line_count.items())
-        stream.write("\n")
-        stream.write("Gen\tOccurance\n")
-        map(lambda x: stream.write("%d\t%d\n" % x), gen_count.items())
+        def section(title, key, fmt):
+            """occurance and (weighted) probability of each value of key"""
+            stats = self.probabilities(key)
+            stream.write(title + "\tOccurance\tProbability\tStdErr\n")
+            for value in sorted(stats):
+                stream.write((fmt + "\t%d\t%g\t%g\n") % ((value,) + stats[value]))
+            stream.write("\n")
+
+        section("Failures", lambda scen: scen.num_kills(), "%d")
+        section("Result", lambda scen: str(scen.result), "%s")
+        section("Bus", lambda scen: len(scen.kill_bus), "%d")
+        section("Line", lambda scen: len(scen.kill_line), "%d")
+        section("Gen", lambda scen: len(scen.kill_gen), "%d")
+
+        stream.write("Result\tEstimate\tCoV\tLower95\tUpper95\n")
+        stats = self.probabilities(lambda scen: str(scen.result))
+        for result in sorted(stats):
+            _, prob, err = stats[result]
+            low, high = max(prob - 1.96 * err, 0.0), prob + 1.96 * err
+            cov = err / prob if prob else float("inf")
+            stream.write("%s\t%g\t%g\t%g\t%g\n" % (result, prob, cov, low, high))
         stream.write("-"*80 + "\n")        
         
 
@@ -355,6 +525,17 @@ class TestRead(ModifiedTestCase):
   set all demand 0.86
   result fail
 """)
+        self.util_readwrite_match(
+            """[name123] pf 7
+  remove bus 2
+  weight 0.125
+  result fail
+""")
+        self.util_readwrite_match(
+            """[name123] pf
+  remove line a9
+  probability 0.0625
+""")
 
 
 class TestAdd(ModifiedTestCase):
@@ -436,7 +617,153 @@ class TestAdd(ModifiedTestCase):
       
         self.assertEqual(len(batch), 1)
         self.assertEqual(batch.size(), 123)
-        
+
+    def test_006(self):
+        batch = SimulationBatch()
+
+        scenarioa = Scenario("a", "pf", 1)
+        scenarioa.weight = 0.5
+        batch.add(scenarioa)
+
+        scenariob = Scenario("b", "pf", 3)
+        scenariob.weight = 0.1
+        batch.add(scenariob)
+
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch.size(), 4)
+        self.assertAlmostEqual(list(batch)[0].weight, 0.2)
+
+
+class TestCompact(ModifiedTestCase):
+
+    def test_kill_lists(self):
+        scen = Scenario("a")
+        scen.kill_bus.append(3)
+        scen.kill_line = ["a1", "a2"]
+        scen.kill_gen.extend(["g1"])
+        self.assertEqual(scen.kill_bus, [3])
+        self.assertEqual(scen.kill_line, ["a1", "a2"])
+        self.assertEqual(scen.kill_gen, ["g1"])
+        self.assertEqual(scen.num_kills(), 4)
+        scen.kill_line = ["a2"]
+        self.assertEqual(scen.kill_line, ["a2"])
+        self.assertEqual(scen.num_kills(), 3)
+
+    def test_kill_list_changes(self):
+        scen = Scenario("a")
+        scen.kill_line = ["a1", "a2", "a3"]
+        scen.kill_line.remove("a1")
+        self.assertEqual(scen.kill_line, ["a2", "a3"])
+        kills = scen.kill_line
+        kills[0] = "a4"
+        del kills[1]
+        self.assertEqual(scen.kill_line, ["a4"])
+        kills.insert(0, "a5")
+        self.assertEqual(kills.pop(), "a4")
+        kills += ["a6"]
+        self.assertEqual(scen.kill_line, ["a5", "a6"])
+        del kills[:]
+        self.assertEqual(scen.num_kills(), 0)
+
+    def test_kill_list_stale(self):
+        scen = Scenario("a")
+        scen.kill_line = ["a1"]
+        kills = scen.kill_line
+        scen.kill_line = []
+        self.assertRaises(Error, kills.append, "a2")
+        self.assertEqual(scen.num_kills(), 0)
+        # other kinds don't make it stale
+        kills = scen.kill_line
+        scen.kill_bus.append(1)
+        kills.append("a2")
+        self.assertEqual(scen.num_kills(), 2)
+
+    def test_kinds(self):
+        bus = Scenario("a")
+        bus.kill_bus.append("x1")
+        line = Scenario("b")
+        line.kill_line.append("x1")
+        self.assertFalse(bus.equal(line))
+        self.assertEqual(line.kill_bus, [])
+
+    def test_order(self):
+        scena = Scenario("a")
+        scena.kill_line = ["a2", "a1"]
+        scenb = Scenario("b")
+        scenb.kill_line.append("a1")
+        scenb.kill_line.append("a2")
+        self.assertTrue(scena.equal(scenb))
+        self.assertEqual(scena.kill_line, ["a1", "a2"])
+        self.assertEqual(scena.dicthash(), scenb.dicthash())
+
+    def test_read_order(self):
+        batch = SimulationBatch()
+        batch.read(StringIO("""[a] pf
+  remove line a9
+  remove line a3
+  remove generator g2
+[b] pf 2
+  remove generator g2
+  remove line a3
+  remove line a9
+"""))
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch.size(), 3)
+        stream = StringIO()
+        batch.write(stream)
+        self.assertEqual(stream.getvalue(), """[a] pf 3
+  remove line a3
+  remove line a9
+  remove generator g2
+""")
+
+    def test_slots(self):
+        self.assertFalse(hasattr(Scenario("a"), "__dict__"))
+
+
+class TestProbability(ModifiedTestCase):
+
+    def setUp(self):
+        self.batch = SimulationBatch()
+        self.batch.read(StringIO("""[a] pf 6
+  result pass
+[b] pf 2
+  remove bus 1
+  weight 0.5
+  result fail
+[c] pf 2
+  remove bus 2
+  weight 0.25
+  result fail
+"""))
+
+    def test_unweighted(self):
+        prob, err = self.batch.probability(lambda scen: scen.title == "a")
+        self.assertAlmostEqual(prob, 0.6)
+        self.assertAlmostEqual(err, math.sqrt(0.6 * 0.4 / 9))
+
+    def test_exact(self):
+        for scen in self.batch:
+            scen.probability = scen.count / 100.0
+        prob, err = self.batch.probability(lambda scen: scen.result == "fail")
+        self.assertAlmostEqual(prob, 0.04)
+        self.assertEqual(err, 0.0)
+
+    def test_weighted(self):
+        prob, _ = self.batch.probability(lambda scen: scen.result == "fail")
+        self.assertAlmostEqual(prob, (2 * 0.5 + 2 * 0.25) / 10)
+
+    def test_probabilities(self):
+        stats = self.batch.probabilities(lambda scen: scen.result)
+        self.assertEqual(sorted(stats), ["fail", "pass"])
+        for result, (count, prob, err) in stats.items():
+            self.assertEqual(count, sum(x.count for x in self.batch 
+                                        if x.result == result))
+            self.assertEqual((prob, err), self.batch.probability(
+                    lambda scen: scen.result == result))
+        self.assertEqual(self.batch.probability(lambda scen: scen.mask & 0), 
+                         (0.0, 0.0))
+
 
 
 #==============================================================================
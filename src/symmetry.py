@@ -0,0 +1,241 @@
+#! /usr/local/bin/python
+# symmetry.py - GeneratorSymmetry
+
+#==============================================================================
+# Copyright (C) 2010 James Brooks (kerspoon)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANDABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#==============================================================================
+
+"""
+by James Brooks 2010
+symmetry.py - GeneratorSymmetry
+"""
+
+#==============================================================================
+#  Imports:
+#==============================================================================
+
+from simulation_batch import Scenario, components
+from psat_data import PsatData
+from modifiedtestcase import ModifiedTestCase
+from StringIO import StringIO
+import unittest
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class GeneratorSymmetry(object):
+    """
+    Classes of interchangeable generating units in a PsatData. Losing
+    either of two identical units on a bus is the same action, so a
+    scenario can be simulated as the canonical one that kills the first
+    units of each class instead.
+
+    A unit is a Supply on its own virtual bus joined to a real bus by a
+    single "c" line with a PV generator and nothing else. Units are
+    identical if they are on the same real bus and their supply,
+    generator, virtual bus and line values all match (and, if `prob` is
+    given, their gen_type, mttf & mttr). The slack is never included.
+    """
+
+    def __init__(self, psat, prob=None):
+
+        reliability = {}
+        if prob is not None:
+            for gen in prob.generators:
+                reliability[gen.name] = (gen.gen_type, gen.mttf, gen.mttr)
+
+        slack_busses = set(slack.bus_no for slack in psat.slack.values())
+
+        def values(item, skip):
+            return tuple(getattr(item, x) for x in item.entries
+                         if x not in skip)
+
+        # the lines (with what is at their other end) at each bus
+        lines_at = {}
+        for line in psat.lines.values():
+            lines_at.setdefault(line.fbus, []).append((line, line.tbus))
+            lines_at.setdefault(line.tbus, []).append((line, line.fbus))
+
+        others = set(psat.loads) | set(psat.shunts) | set(psat.demand)
+        supplies_at = {}
+        for supply in psat.supply.values():
+            supplies_at.setdefault(supply.bus_no, []).append(supply)
+
+        units = {}
+        for supply in psat.supply.values():
+            bus_no = supply.bus_no
+            if (bus_no in slack_busses or bus_no in others or
+                bus_no not in psat.generators or
+                len(supplies_at[bus_no]) != 1 or
+                len(lines_at.get(bus_no, [])) != 1):
+                continue
+            line, real_bus = lines_at[bus_no][0]
+            if not line.cid.startswith("c"):
+                continue
+
+            key = (real_bus,
+                   line.fbus == bus_no,
+                   values(line, ("fbus", "tbus", "cid")),
+                   values(psat.busses[bus_no], ("bus_no",)),
+                   values(psat.generators[bus_no], ("bus_no",)),
+                   values(supply, ("bus_no", "cid")),
+                   reliability.get(supply.cid))
+            units.setdefault(key, []).append((supply.cid, bus_no, line.cid))
+
+        # each class as its bit masks: the whole class, the first `k`
+        # units of it and the components that would make it asymmetric.
+        self.classes = []
+        for key, members in sorted(units.items()):
+            if len(members) < 2:
+                continue
+            members.sort()
+            prefixes = [0]
+            for cid, _, _ in members:
+                prefixes.append(prefixes[-1] | components.bit("generator", cid))
+            touch = 0
+            for _, bus_no, line_cid in members:
+                touch |= components.bit("bus", bus_no)
+                touch |= components.bit("line", line_cid)
+            self.classes.append(([x[0] for x in members],
+                                 prefixes[-1], prefixes, touch))
+
+    def __len__(self):
+        return len(self.classes)
+
+    def canonical_mask(self, mask):
+        """`mask` with the killed units of each class replaced by the
+           same number of units from the start of the class. A class
+           is left alone if one of its virtual busses or lines is
+           killed directly."""
+        for _, whole, prefixes, touch in self.classes:
+            if mask & whole and not mask & touch:
+                killed = bin(mask & whole).count("1")
+                mask = (mask & ~whole) | prefixes[killed]
+        return mask
+
+    def dicthash(self, scenario):
+        """like Scenario.dicthash but the same for equivalent scenarios"""
+        return (scenario.simtype, scenario.all_demand,
+                self.canonical_mask(scenario.mask))
+
+    def canonical(self, scenario):
+        """a copy of `scenario` with the canonical kills"""
+        scen = Scenario(scenario.title, scenario.simtype, scenario.count)
+        scen.mask = self.canonical_mask(scenario.mask)
+        scen.all_demand = scenario.all_demand
+        scen.weight = scenario.weight
+        scen.probability = scenario.probability
+        scen.result = scenario.result
+        return scen
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+class Test_symmetry(ModifiedTestCase):
+
+    def setUp(self):
+        self.psat = PsatData()
+        self.psat.read(StringIO("""Bus.con = [ ...
+1 138 1 0 2 1;
+2 138 1 0 2 1;
+11 138 1 0 2 1;
+12 138 1 0 2 1;
+13 138 1 0 2 1;
+14 138 1 0 2 1;
+];
+
+Line.con = [ ...
+1 2 100 138 60 0.0 0.0 0.0026 0.0139 0.4611 0.0 0.0 1.93 0.0 2.0 1; %a1
+1 11 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-1
+1 12 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-2
+1 13 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-3
+1 14 100 138 60 0.0 0.0 0.0 0.0001 0.0 0.0 0.0 999 0.0 999 1; %c1-4
+];
+
+SW.con = [ ...
+2 100 138 1.04 0.0 1.5 -1.5 1.1 0.9 1.0 1 1 1;
+];
+
+Supply.con = [ ...
+ 11 100 0.1 0.2 0.1 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g1
+ 12 100 0.1 0.2 0.1 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g2
+ 13 100 0.76 0.76 0.152 0 3.5 10.2386 0.038404 0 0 0 0 0 1 0.3 -0.25 0 0 1; %g3
+ 14 100 0.1 0.2 0.1 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g4
+  2 100 0.1 0.2 0.1 0 1.72 24.8415 0.36505 0 0 0 0 0 1 0.1 0 0 0 1; %g5
+];
+
+PV.con = [ ...
+ 11 100 138 0.15 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 12 100 138 0.15 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 13 100 138 0.76 1.035 0.8 -0.5 1.05 0.95 1.0 1
+ 14 100 138 0.15 1.035 0.8 -0.5 1.05 0.95 1.0 1
+];"""))
+        self.symmetry = GeneratorSymmetry(self.psat)
+
+    def scenario(self, gens, busses=(), lines=()):
+        scen = Scenario("x")
+        scen.kill_gen = gens
+        scen.kill_bus = busses
+        scen.kill_line = lines
+        return scen
+
+    def test_classes(self):
+        self.assertEqual([x[0] for x in self.symmetry.classes],
+                         [["g1", "g2", "g4"]])
+
+    def test_equivalent(self):
+        key = self.symmetry.dicthash
+        self.assertEqual(key(self.scenario(["g4"])),
+                         key(self.scenario(["g1"])))
+        self.assertEqual(key(self.scenario(["g2", "g4", "g3"])),
+                         key(self.scenario(["g1", "g2", "g3"])))
+        self.assertNotEqual(key(self.scenario(["g3"])),
+                            key(self.scenario(["g1"])))
+        self.assertNotEqual(key(self.scenario(["g1", "g2"])),
+                            key(self.scenario(["g1"])))
+        self.assertEqual(self.symmetry.canonical(
+                self.scenario(["g4", "g3"])).kill_gen, ["g1", "g3"])
+
+    def test_touched(self):
+        key = self.symmetry.dicthash
+        self.assertNotEqual(key(self.scenario(["g4"], lines=["c1-1"])),
+                            key(self.scenario(["g1"], lines=["c1-1"])))
+        self.assertEqual(key(self.scenario(["g4"], lines=["a1"])),
+                         key(self.scenario(["g2"], lines=["a1"])))
+
+    def test_dispatch(self):
+        self.psat.generators[12].p = 0.2
+        self.assertEqual([x[0] for x in GeneratorSymmetry(self.psat).classes],
+                         [["g1", "g4"]])
+
+
+#==============================================================================
+#
+#==============================================================================
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+#==============================================================================
+#
+#==============================================================================